@@ -0,0 +1,131 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+from embeddings import get_embedder, embedder_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_DIR = os.path.join(".cache", "answer_index")
+INITIAL_CAPACITY = 1024
+
+
+class AnswerIndex:
+    """Vector index of previous doctor-patient communications.
+
+    Question embeddings live in a preallocated float32 matrix in vectors.npy,
+    opened as a memory map so a large index loads instantly and is shared
+    through the page cache. entries.jsonl is an append-only log of
+    {"id", "question", "answer"} records; on load the last record for an id
+    wins, so an upsert is one row write plus one appended line. The matrix
+    doubles in capacity when it fills up. meta.json names the embedder that
+    built the vectors; opening the index with a different one is an error.
+    """
+
+    def __init__(self, directory=DEFAULT_INDEX_DIR, embedder=None):
+        self.directory = directory
+        self.embedder = embedder or get_embedder()
+        self._vectors_path = os.path.join(directory, "vectors.npy")
+        self._entries_path = os.path.join(directory, "entries.jsonl")
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._lock = threading.Lock()
+        self._entries = []
+        self._rows = {}
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(self._vectors_path):
+            self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="r+")
+            if self._vectors.shape[1] != self.embedder.dim:
+                raise ValueError(f"Index at {directory} has dimension {self._vectors.shape[1]}, embedder has {self.embedder.dim}")
+            built_with = self._load_meta()
+            if built_with != embedder_name(self.embedder):
+                raise ValueError(f"Index at {directory} was built with the {built_with} embedder, not {embedder_name(self.embedder)}; rebuild it")
+            self._load_entries()
+        else:
+            self._vectors = self._allocate(INITIAL_CAPACITY)
+            with open(self._meta_path, "w", encoding="utf-8") as meta_file:
+                json.dump({"embedder": embedder_name(self.embedder), "dim": self.embedder.dim}, meta_file)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load_meta(self):
+        # Indexes written before meta.json existed were always hashed
+        if not os.path.exists(self._meta_path):
+            return "hashing"
+        with open(self._meta_path, "r", encoding="utf-8") as meta_file:
+            return json.load(meta_file)["embedder"]
+
+    def _allocate(self, capacity):
+        return np.lib.format.open_memmap(self._vectors_path, mode="w+", dtype=np.float32, shape=(capacity, self.embedder.dim))
+
+    def _load_entries(self):
+        if not os.path.exists(self._entries_path):
+            return
+        with open(self._entries_path, "r", encoding="utf-8") as entries_file:
+            for line in entries_file:
+                entry = json.loads(line)
+                row = self._rows.get(entry["id"])
+                if row is None:
+                    self._rows[entry["id"]] = len(self._entries)
+                    self._entries.append(entry)
+                else:
+                    self._entries[row] = entry
+
+    def _grow(self, needed):
+        capacity = self._vectors.shape[0]
+        while capacity < needed:
+            capacity *= 2
+        grown = np.lib.format.open_memmap(self._vectors_path + ".tmp", mode="w+", dtype=np.float32, shape=(capacity, self.embedder.dim))
+        grown[:len(self._entries)] = self._vectors[:len(self._entries)]
+        grown.flush()
+        del grown
+        self._vectors = None
+        os.replace(self._vectors_path + ".tmp", self._vectors_path)
+        self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="r+")
+
+    def upsert_many(self, records):
+        """Insert or replace {"id", "question", "answer"} records, embedding them in one batch."""
+        records = list(records)
+        if not records:
+            return
+        vectors = self.embedder.embed([record["question"] for record in records])
+        with self._lock:
+            new_ids = {record["id"] for record in records if record["id"] not in self._rows}
+            if len(self._entries) + len(new_ids) > self._vectors.shape[0]:
+                self._grow(len(self._entries) + len(new_ids))
+            with open(self._entries_path, "a", encoding="utf-8") as entries_file:
+                for record, vector in zip(records, vectors):
+                    entry = {"id": record["id"], "question": record["question"], "answer": record["answer"]}
+                    row = self._rows.get(entry["id"])
+                    if row is None:
+                        row = len(self._entries)
+                        self._rows[entry["id"]] = row
+                        self._entries.append(entry)
+                    else:
+                        self._entries[row] = entry
+                    self._vectors[row] = vector
+                    entries_file.write(json.dumps(entry) + "\n")
+            self._vectors.flush()
+
+    def upsert(self, entry_id, question, answer):
+        self.upsert_many([{"id": entry_id, "question": question, "answer": answer}])
+
+    def search(self, question, k=3):
+        """Top-k entries by cosine similarity, as (score, entry) pairs, best first."""
+        count = len(self._entries)
+        if count == 0:
+            return []
+        scores = self._vectors[:count] @ self.embedder.embed_one(question)
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[row]), self._entries[row]) for row in top]
+
+    def find_answer(self, question, threshold):
+        """The stored answer to the closest previous question, if it scores at least threshold."""
+        matches = self.search(question, k=1)
+        if matches and matches[0][0] >= threshold:
+            return matches[0]
+        return None
@@ -0,0 +1,125 @@
+import os
+import re
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Whisper rejects uploads above 25 MB
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+SILENCE_NOISE_DB = -35
+SILENCE_MIN_SECONDS = 0.5
+TARGET_CHUNK_SECONDS = 60
+MAX_CHUNK_SECONDS = 90
+OVERLAP_SECONDS = 1.5
+MAX_OVERLAP_WORDS = 20
+
+_SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?[\d.]+)")
+
+
+def probe_duration(file_path):
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip())
+
+
+def detect_silences(file_path, noise_db=SILENCE_NOISE_DB, min_silence=SILENCE_MIN_SECONDS):
+    """Returns the (start, end) seconds of every silent stretch ffmpeg finds."""
+    stderr = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", file_path, "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"],
+        capture_output=True, text=True, check=True
+    ).stderr
+    silences = []
+    start = None
+    for kind, value in _SILENCE_PATTERN.findall(stderr):
+        if kind == "start":
+            start = max(0.0, float(value))
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    return silences
+
+
+def plan_chunks(duration, silences, target=TARGET_CHUNK_SECONDS, max_length=MAX_CHUNK_SECONDS, overlap=OVERLAP_SECONDS):
+    """Split [0, duration] at the silence closest to every `target` seconds.
+
+    A cut falls in the middle of a silence when one exists between half the
+    target and max_length into the chunk, otherwise at max_length. Every chunk
+    is then widened by `overlap` on both sides so no word is lost at a cut.
+    """
+    cut_points = [(start + end) / 2 for start, end in silences]
+    boundaries = [0.0]
+    while duration - boundaries[-1] > max_length:
+        chunk_start = boundaries[-1]
+        candidates = [cut for cut in cut_points if chunk_start + target / 2 <= cut <= chunk_start + max_length]
+        if candidates:
+            boundaries.append(min(candidates, key=lambda cut: abs(cut - (chunk_start + target))))
+        else:
+            boundaries.append(chunk_start + max_length)
+    boundaries.append(duration)
+    return [
+        (max(0.0, start - overlap), min(duration, end + overlap))
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
+
+
+def extract_chunk(file_path, start, end, output_path):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}",
+         "-i", file_path, "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k", output_path],
+        check=True
+    )
+
+
+def _normalize_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def merge_transcripts(texts, max_overlap_words=MAX_OVERLAP_WORDS):
+    """Join chunk transcripts in order, dropping words repeated across an overlap.
+
+    The longest run of words that ends one chunk and starts the next (compared
+    without case or punctuation) is kept only once.
+    """
+    merged = []
+    for text in texts:
+        words = text.split()
+        if merged and words:
+            tail = [_normalize_word(word) for word in merged[-max_overlap_words:]]
+            head = [_normalize_word(word) for word in words[:max_overlap_words]]
+            for size in range(min(len(tail), len(head)), 0, -1):
+                if tail[-size:] == head[:size]:
+                    words = words[size:]
+                    break
+        merged.extend(words)
+    return " ".join(merged)
+
+
+def needs_chunking(file_path, max_seconds=MAX_CHUNK_SECONDS):
+    if os.path.getsize(file_path) > WHISPER_MAX_UPLOAD_BYTES:
+        return True
+    return probe_duration(file_path) > max_seconds
+
+
+def transcribe_chunked(file_path, transcribe_chunk, workers=4):
+    """Transcribe a long recording as overlapping chunks in parallel.
+
+    transcribe_chunk(chunk_path) returns the text of one chunk; the chunks run
+    concurrently on `workers` threads, so the wall time is close to that of the
+    slowest chunk rather than the whole recording.
+    """
+    duration = probe_duration(file_path)
+    chunks = plan_chunks(duration, detect_silences(file_path))
+    logger.info(f"Split {file_path} ({duration:.0f}s) into {len(chunks)} chunks")
+
+    with tempfile.TemporaryDirectory(prefix="docotoc-chunks-") as chunk_dir:
+        chunk_paths = [os.path.join(chunk_dir, f"chunk_{index:04d}.mp3") for index in range(len(chunks))]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk") as pool:
+            list(pool.map(lambda args: extract_chunk(file_path, *args), [(start, end, path) for (start, end), path in zip(chunks, chunk_paths)]))
+            texts = list(pool.map(transcribe_chunk, chunk_paths))
+    return merge_transcripts(texts)
@@ -0,0 +1,108 @@
+import os
+import logging
+import subprocess
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+# A frame is speech when it is this many dB above the recording's noise floor
+SPEECH_MARGIN_DB = 12
+# ... but never more than this many dB below the loudest frames, so a
+# recording with no real silence does not treat its quieter speech as noise
+SPEECH_RANGE_DB = 30
+MIN_SPEECH_DBFS = -55
+PAD_SECONDS = 0.2
+MAX_PAUSE_SECONDS = 0.6
+OPUS_BITRATE = "24k"
+
+
+def decode_audio(file_path, sample_rate=SAMPLE_RATE):
+    """Decode any ffmpeg-readable file to mono 16-bit PCM at sample_rate."""
+    pcm = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", file_path, "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "-"],
+        capture_output=True, check=True
+    ).stdout
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+def speech_frames(samples, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS):
+    """Energy-based voice activity detection, one boolean per frame.
+
+    The noise floor is the 10th percentile of frame energy, so the threshold
+    adapts to each recording's background level. That assumes at least a tenth
+    of the recording is silence; when it is not, the floor is quiet speech, so
+    the threshold is also capped at SPEECH_RANGE_DB below the loudest frames.
+    """
+    frame_length = sample_rate * frame_ms // 1000
+    frame_count = len(samples) // frame_length
+    if frame_count == 0:
+        return np.zeros(0, dtype=bool), frame_length
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length).astype(np.float32) / 32768
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    floor, peak = np.percentile(energy_db, [10, 95])
+    threshold = max(min(floor + SPEECH_MARGIN_DB, peak - SPEECH_RANGE_DB), MIN_SPEECH_DBFS)
+    return energy_db > threshold, frame_length
+
+
+def trim_silence(samples, sample_rate=SAMPLE_RATE, pad_seconds=PAD_SECONDS, max_pause_seconds=MAX_PAUSE_SECONDS):
+    """Drop leading/trailing silence and shorten internal pauses to max_pause_seconds."""
+    is_speech, frame_length = speech_frames(samples, sample_rate)
+    if not is_speech.any():
+        return samples
+
+    # Keep a little context around speech so word onsets and endings survive
+    pad_frames = int(pad_seconds * sample_rate / frame_length)
+    kept = np.convolve(is_speech, np.ones(2 * pad_frames + 1, dtype=int), mode="same") > 0
+
+    # Shorten every remaining silent run longer than max_pause_seconds
+    max_pause_frames = int(max_pause_seconds * sample_rate / frame_length)
+    speech_indices = np.flatnonzero(kept)
+    first, last = speech_indices[0], speech_indices[-1]
+    keep_frames = np.zeros_like(kept)
+    keep_frames[first:last + 1] = True
+    gaps = np.flatnonzero(np.diff(speech_indices) > max_pause_frames + 1)
+    for gap in gaps:
+        start = speech_indices[gap] + 1 + max_pause_frames
+        end = speech_indices[gap + 1]
+        keep_frames[start:end] = False
+
+    sample_mask = np.repeat(keep_frames, frame_length)
+    tail = samples[len(sample_mask):] if keep_frames[-1] else samples[:0]
+    return np.concatenate([samples[:len(sample_mask)][sample_mask], tail])
+
+
+def encode_opus(samples, output_path, sample_rate=SAMPLE_RATE, bitrate=OPUS_BITRATE):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "-",
+         "-c:a", "libopus", "-b:a", bitrate, "-application", "voip", output_path],
+        input=samples.tobytes(), check=True
+    )
+
+
+def preprocess_audio(file_path, output_dir):
+    """Trim silence, downmix to 16 kHz mono and re-encode as Opus for upload.
+
+    Returns the path of the compact file and a dict with the bytes and seconds
+    before and after, which is also logged.
+    """
+    samples = decode_audio(file_path)
+    trimmed = trim_silence(samples)
+    output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(file_path))[0] + ".ogg")
+    encode_opus(trimmed, output_path)
+
+    stats = {
+        "original_bytes": os.path.getsize(file_path),
+        "processed_bytes": os.path.getsize(output_path),
+        "original_seconds": len(samples) / SAMPLE_RATE,
+        "processed_seconds": len(trimmed) / SAMPLE_RATE
+    }
+    stats["saved_bytes"] = stats["original_bytes"] - stats["processed_bytes"]
+    stats["saved_seconds"] = stats["original_seconds"] - stats["processed_seconds"]
+    logger.info(
+        f"Preprocessed {file_path}: saved {stats['saved_bytes'] / 1024:.0f} KB "
+        f"({stats['original_bytes'] / 1024:.0f} -> {stats['processed_bytes'] / 1024:.0f} KB) and "
+        f"{stats['saved_seconds']:.1f}s ({stats['original_seconds']:.1f} -> {stats['processed_seconds']:.1f}s)"
+    )
+    return output_path, stats
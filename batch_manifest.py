@@ -0,0 +1,106 @@
+import os
+import glob
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".mp3", ".mp4", ".mpeg", ".mpga", ".m4a", ".wav", ".webm", ".ogg", ".flac")
+
+
+def expand_audio_paths(patterns):
+    """Audio files named by paths, directories (searched recursively) and glob patterns, in order, without duplicates."""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(pattern)
+                for name in names
+                if name.lower().endswith(AUDIO_EXTENSIONS)
+            )
+        elif glob.has_magic(pattern):
+            matches = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+            if not matches:
+                logger.warning(f"No files match {pattern}")
+        else:
+            matches = [pattern]
+        paths.extend(matches)
+    return list(dict.fromkeys(paths))
+
+
+def file_fingerprint(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class BatchManifest:
+    """Append-only JSONL record of batch progress, used to resume interrupted runs.
+
+    Each finished stage appends {"file", "fingerprint", "stage", "status":
+    "done", "outputs", "time"}, each failed one {"status": "failed", "error"}
+    instead of outputs. On load the outputs of a file's done stages are merged;
+    records whose fingerprint (size and mtime) no longer matches the file are
+    ignored, so an edited recording is processed again. A line cut short by a
+    crash is skipped, and the next record is written on a new line after it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._outputs = {}
+        # Set when the file ends in a line cut short by a crash, so the next
+        # record starts on a line of its own instead of extending it
+        self._needs_newline = False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as manifest_file:
+            for line_number, line in enumerate(manifest_file, 1):
+                self._needs_newline = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable line {line_number} of {self.path}")
+                    continue
+                key = (record["file"], record["fingerprint"])
+                if record["status"] == "done":
+                    self._outputs.setdefault(key, {}).update(record["outputs"])
+
+    def _append(self, record):
+        record["time"] = time.time()
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._needs_newline:
+                line = "\n" + line
+            with open(self.path, "a", encoding="utf-8") as manifest_file:
+                manifest_file.write(line)
+            self._needs_newline = False
+
+    def completed_outputs(self, file_path):
+        """Outputs of the stages already done for file_path in its current state."""
+        key = (os.path.abspath(file_path), file_fingerprint(file_path))
+        with self._lock:
+            return dict(self._outputs.get(key, {}))
+
+    def record_done(self, file_path, stage, outputs):
+        key = (os.path.abspath(file_path), file_fingerprint(file_path))
+        with self._lock:
+            self._outputs.setdefault(key, {}).update(outputs)
+        self._append({"file": key[0], "fingerprint": key[1], "stage": stage, "status": "done", "outputs": outputs})
+
+    def record_failed(self, file_path, stage, error):
+        self._append({
+            "file": os.path.abspath(file_path),
+            "fingerprint": file_fingerprint(file_path),
+            "stage": stage,
+            "status": "failed",
+            "error": error
+        })
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import importlib
+import tempfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import aiohttp
+from aiohttp import web
+from openai import OpenAI
+from mock_openai import MockOpenAI, start_mock_server
+from scheduler import get_scheduler
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESULTS_DIR = "benchmark_results"
+FLOWS = ("interactive", "batch", "api")
+SAMPLE_QUESTIONS = [
+    "How often should I check my blood sugar when I start insulin",
+    "Should I keep taking calcium supplements after my bone scan",
+    "Can I stop my hypertension meds if my readings are normal",
+    "Is my asthma inhaler safe to use during pregnancy",
+    "Does metformin cause constipation and what can I do about it",
+    "What are the new options for treating my depression",
+]
+
+
+def load_app():
+    # open-ai-app.py is not a valid module name for a plain import
+    return importlib.import_module("open-ai-app")
+
+
+def question_for(index):
+    # Numbered so that no two sessions share a cache entry
+    return f"{SAMPLE_QUESTIONS[index % len(SAMPLE_QUESTIONS)]} (patient {index})?"
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(latencies))}
+
+
+def run_interactive_flow(app, client, concurrency, sessions, stream):
+    """Each session asks a question, confirms it and gets the email; latency is per patient turn."""
+    def session(index):
+        latencies = []
+        history = []
+        for user_input in (question_for(index), "yes"):
+            started = time.perf_counter()
+            response = app.handle_patient_interaction(client, user_input, history, stream=stream)
+            question_json = app.parse_patient_question(response)
+            if question_json is not None:
+                app.generate_email(client, question_json["patient_question"], question_json["doctor_name"], "Patient", stream=stream)
+            latencies.append(time.perf_counter() - started)
+            history += [{"role": "user", "content": user_input}, {"role": "assistant", "content": response}]
+        return latencies
+
+    return run_in_threads(session, concurrency, sessions)
+
+
+def run_batch_flow(app, client, concurrency, files, audio_kb, fused):
+    """process_batch over synthetic recordings with every stage concurrency wide; latency is per file."""
+    with tempfile.TemporaryDirectory(prefix="docotoc-bench-") as audio_dir:
+        audio_paths = []
+        for index in range(files):
+            path = os.path.join(audio_dir, f"{index}_recording.mp3")
+            with open(path, "wb") as audio_file:
+                audio_file.write(os.urandom(audio_kb * 1024))
+            audio_paths.append(path)
+
+        results = app.process_batch(
+            client, audio_paths,
+            transcribe_workers=concurrency, correct_workers=concurrency, email_workers=concurrency,
+            fused=fused
+        )
+    latencies = [result["elapsed"] for result in results if not result["error"]]
+    return latencies, sum(1 for result in results if result["error"])
+
+
+def run_in_threads(session, concurrency, sessions):
+    latencies, errors = [], 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(session, index) for index in range(sessions)]:
+            try:
+                latencies.extend(future.result())
+            except Exception as e:
+                logger.error(f"Session failed: {str(e)}")
+                errors += 1
+    return latencies, errors
+
+
+async def run_api_flow_async(app, base_url, concurrency, sessions):
+    api = app.PatientApi(app.create_async_client("mock", base_url=base_url), sessions=SessionStore())
+    runner = web.AppRunner(api.build_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    api_url = f"http://{host}:{port}"
+
+    latencies, errors = [], 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def session(http, index):
+        nonlocal errors
+        async with limit:
+            try:
+                async with http.post(f"{api_url}/sessions", json={"patient_name": "Patient"}) as response:
+                    session_id = (await response.json())["session_id"]
+                for message in (question_for(index), "yes"):
+                    started = time.perf_counter()
+                    async with http.post(f"{api_url}/sessions/{session_id}/interaction", json={"message": message}) as response:
+                        response.raise_for_status()
+                        await response.read()
+                    latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                logger.error(f"Session failed: {str(e)}")
+                errors += 1
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as http:
+            await asyncio.gather(*[session(http, index) for index in range(sessions)])
+    finally:
+        await runner.cleanup()
+    return latencies, errors
+
+
+def run_flow(app, flow, client, base_url, concurrency, args):
+    if flow == "interactive":
+        return run_interactive_flow(app, client, concurrency, args.sessions, args.stream)
+    if flow == "batch":
+        return run_batch_flow(app, client, concurrency, args.files, args.audio_kb, args.fused)
+    return asyncio.run(run_api_flow_async(app, base_url, concurrency, args.sessions))
+
+
+def run_benchmarks(args):
+    app = load_app()
+    mock = MockOpenAI(
+        latency=args.latency,
+        token_delay=args.token_delay,
+        audio_latency=args.audio_latency,
+        error_rate=args.error_rate,
+        retry_after_ms=args.retry_after_ms,
+        seed=args.seed
+    )
+    base_url, stop = start_mock_server(mock)
+    client = OpenAI(api_key="mock", base_url=base_url, max_retries=0)
+    scheduler = get_scheduler()
+    runs = []
+    try:
+        for flow in args.flows:
+            for concurrency in args.concurrency:
+                mock.reset_stats()
+                before = dict(scheduler.stats)
+                started = time.perf_counter()
+                latencies, errors = run_flow(app, flow, client, base_url, concurrency, args)
+                wall = time.perf_counter() - started
+                run = {
+                    "flow": flow,
+                    "concurrency": concurrency,
+                    "completed": len(latencies),
+                    "errors": errors,
+                    "wall_seconds": wall,
+                    "throughput_per_second": len(latencies) / wall if wall > 0 else 0.0,
+                    "latency": latency_summary(latencies),
+                    "retries": scheduler.stats["retries"] - before["retries"],
+                    "rate_limited": scheduler.stats["rate_limited"] - before["rate_limited"],
+                    "mock": dict(mock.stats)
+                }
+                runs.append(run)
+                print_run(run)
+    finally:
+        stop()
+    return runs
+
+
+def print_run(run):
+    latency = run["latency"]
+    if latency["p50"] is None:
+        print(f"{run['flow']:<12} c={run['concurrency']:<4} no successful requests ({run['errors']} errors)")
+        return
+    print(
+        f"{run['flow']:<12} c={run['concurrency']:<4} "
+        f"p50 {latency['p50'] * 1000:7.0f}ms  p95 {latency['p95'] * 1000:7.0f}ms  p99 {latency['p99'] * 1000:7.0f}ms  "
+        f"{run['throughput_per_second']:7.1f}/s  retries {run['retries']:<4} errors {run['errors']}"
+    )
+
+
+def save_results(args, runs):
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(args.output_dir, f"{stamp}-{args.label}.json")
+    config = {key: value for key, value in vars(args).items() if key not in ("output_dir", "compare")}
+    with open(path, "w", encoding="utf-8") as results_file:
+        json.dump({"label": args.label, "created": stamp, "config": config, "runs": runs}, results_file, indent=2)
+    return path
+
+
+def compare_results(baseline_path, runs):
+    """Prints p50/p95 and throughput against a saved run, matched on flow and concurrency."""
+    with open(baseline_path, "r", encoding="utf-8") as baseline_file:
+        baseline = {(run["flow"], run["concurrency"]): run for run in json.load(baseline_file)["runs"]}
+
+    def change(new, old):
+        if new is None or not old:
+            return "   n/a"
+        return f"{(new - old) / old:+6.0%}"
+
+    print(f"\nCompared with {baseline_path}:")
+    for run in runs:
+        old = baseline.get((run["flow"], run["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"{run['flow']:<12} c={run['concurrency']:<4} "
+            f"p50 {change(run['latency']['p50'], old['latency']['p50'])}  "
+            f"p95 {change(run['latency']['p95'], old['latency']['p95'])}  "
+            f"throughput {change(run['throughput_per_second'], old['throughput_per_second'])}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the DocoToc flows against a local mock of the OpenAI API")
+    parser.add_argument("--flows", nargs="+", choices=FLOWS, default=list(FLOWS), help="Flows to run")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32], help="Concurrency levels to run each flow at")
+    parser.add_argument("--sessions", type=int, default=64, help="Patient sessions per interactive or api run")
+    parser.add_argument("--files", type=int, default=32, help="Recordings per batch run")
+    parser.add_argument("--audio-kb", type=int, default=256, help="Size of each synthetic recording")
+    parser.add_argument("--stream", action="store_true", help="Stream interactive replies")
+    parser.add_argument("--fused", action="store_true", help="Use the fused correction and email call in batch runs")
+    parser.add_argument("--latency", type=float, default=0.3, help="Mock seconds before every chat response")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Mock seconds per completion token")
+    parser.add_argument("--audio-latency", type=float, default=0.5, help="Mock seconds per transcription")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests answered with a 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms sent with injected 429s")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the mock's jitter and 429s")
+    parser.add_argument("--label", default="run", help="Name saved with the results")
+    parser.add_argument("--output-dir", default=DEFAULT_RESULTS_DIR, help="Directory the results JSON is written to")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare with")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # The mock is not rate limited unless DOCOTOC_RPM / DOCOTOC_TPM say otherwise,
+    # and nothing is served from or written to the response cache
+    os.environ.setdefault("DOCOTOC_RPM", "1000000")
+    os.environ.setdefault("DOCOTOC_TPM", "1000000000")
+    os.environ["DOCOTOC_RESPONSE_CACHE_DB"] = ""
+
+    runs = run_benchmarks(args)
+    path = save_results(args, runs)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        compare_results(args.compare, runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import re
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Per-message overhead of the chat format (role and separators), as documented
+# in the OpenAI cookbook for gpt-4.
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_LINE_TOKENS = 40
+
+
+class TokenCounter:
+    """Counts tokens with tiktoken, or estimates ~4 characters per token without it."""
+
+    def __init__(self, model="gpt-4"):
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                # tiktoken downloads its BPE files on first use, which fails offline
+                logger.warning(f"Falling back to estimated token counts: {str(e)}")
+
+    def count(self, text):
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return (len(text) + 3) // 4
+
+    def count_message(self, content):
+        return self.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def truncate(self, text, max_tokens):
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text)
+            if len(tokens) <= max_tokens:
+                return text
+            return self._encoding.decode(tokens[:max_tokens]) + "..."
+        if len(text) <= max_tokens * 4:
+            return text
+        return text[:max_tokens * 4] + "..."
+
+
+_shared_counter = None
+
+
+def shared_token_counter():
+    """One TokenCounter for every context, so many open sessions don't each hold one."""
+    global _shared_counter
+    if _shared_counter is None:
+        _shared_counter = TokenCounter()
+    return _shared_counter
+
+
+class ConversationContext:
+    """Conversation history kept under a token budget.
+
+    The most recent turns are sent verbatim. When they no longer fit in
+    max_tokens, the oldest turns are folded into a compact summary (the first
+    sentence of each, clipped) that is sent as a single system message, and the
+    summary itself is capped at summary_max_tokens. Token counts are kept per
+    turn, so adding a turn costs the same however long the session runs.
+    Turns are held as (role, content) tuples; to_state()/from_state() convert
+    the history to and from plain lists for storage.
+    """
+
+    def __init__(self, max_tokens=1500, summary_max_tokens=300, min_recent_turns=2, token_counter=None):
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.min_recent_turns = min_recent_turns
+        self.token_counter = token_counter or shared_token_counter()
+        self._turns = []
+        self._turn_tokens = []
+        self._summary_lines = []
+        self._summary_tokens = []
+
+    def add(self, role, content):
+        self._turns.append((role, content))
+        self._turn_tokens.append(self.token_counter.count_message(content))
+        self._trim()
+
+    def messages(self):
+        turns = [{"role": role, "content": content} for role, content in self._turns]
+        if not self._summary_lines:
+            return turns
+        summary = "Summary of the earlier conversation:\n" + "\n".join(self._summary_lines)
+        return [{"role": "system", "content": summary}, *turns]
+
+    def to_state(self):
+        """JSON-serialisable snapshot of the history, token counts included."""
+        return [
+            [[role, content, tokens] for (role, content), tokens in zip(self._turns, self._turn_tokens)],
+            [[line, tokens] for line, tokens in zip(self._summary_lines, self._summary_tokens)]
+        ]
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        context = cls(**kwargs)
+        turns, summary = state
+        context._turns = [(role, content) for role, content, _ in turns]
+        context._turn_tokens = [tokens for _, _, tokens in turns]
+        context._summary_lines = [line for line, _ in summary]
+        context._summary_tokens = [tokens for _, tokens in summary]
+        return context
+
+    def token_count(self):
+        total = sum(self._turn_tokens)
+        if self._summary_lines:
+            total += sum(self._summary_tokens) + MESSAGE_OVERHEAD_TOKENS
+        return total
+
+    def _trim(self):
+        while self.token_count() > self.max_tokens and len(self._turns) > self.min_recent_turns:
+            self._fold_into_summary(self._turns.pop(0))
+            self._turn_tokens.pop(0)
+
+    def _fold_into_summary(self, turn):
+        role, content = turn
+        speaker = "Patient" if role == "user" else "DocoToc"
+        first_sentence = re.split(r"(?<=[.!?])\s", content.strip(), maxsplit=1)[0]
+        line = f"{speaker}: {self.token_counter.truncate(first_sentence, SUMMARY_LINE_TOKENS)}"
+        self._summary_lines.append(line)
+        self._summary_tokens.append(self.token_counter.count(line) + 1)
+        # Keep the opening line, which usually states what the patient came for
+        while sum(self._summary_tokens) > self.summary_max_tokens and len(self._summary_lines) > 1:
+            self._summary_lines.pop(1)
+            self._summary_tokens.pop(1)
@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+import numpy as np
+from embeddings import get_embedder, embedder_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY_PATH = "doctors.jsonl"
+# Keeps the hashed profile matrix small: 50,000 doctors take 50 MB and score
+# in a few milliseconds, plus about a millisecond to embed the question
+DOCTOR_EMBEDDING_DIM = 256
+
+
+def doctor_profile_text(doctor):
+    # The specialty is repeated so it outweighs the free-text profile
+    specialty = doctor.get("specialty", "")
+    return f"{specialty}. {specialty}. {doctor.get('profile', '')}"
+
+
+class DoctorMatcher:
+    """Ranks every doctor in a directory against a patient question at once.
+
+    Doctor profiles are embedded ahead of time into one float32 matrix that is
+    cached next to the directory file (<directory>.npy, with the embedder's
+    name in <directory>.npy.json) and memory-mapped on later loads; it is
+    rebuilt when the directory file is newer or the embedder changed. Matching a
+    question is a single matrix-vector product plus argpartition.
+
+    The default hashed n-gram embedder only matches shared words, so a question
+    about symptoms ("chest pain") may rank an unrelated specialty first; set
+    DOCOTOC_EMBEDDING_MODEL for a semantic embedder (see embeddings.get_embedder).
+    """
+
+    def __init__(self, doctors, matrix, embedder):
+        self.doctors = doctors
+        self.matrix = matrix
+        self.embedder = embedder
+
+    @classmethod
+    def from_directory(cls, path=DEFAULT_DIRECTORY_PATH, embedder=None):
+        embedder = embedder or get_embedder(DOCTOR_EMBEDDING_DIM)
+        with open(path, "r", encoding="utf-8") as directory_file:
+            doctors = [json.loads(line) for line in directory_file if line.strip()]
+
+        matrix_path = path + ".npy"
+        meta_path = matrix_path + ".json"
+        matrix = None
+        if os.path.exists(matrix_path) and os.path.exists(meta_path) and os.path.getmtime(matrix_path) >= os.path.getmtime(path):
+            with open(meta_path, "r", encoding="utf-8") as meta_file:
+                built_with = json.load(meta_file).get("embedder")
+            matrix = np.load(matrix_path, mmap_mode="r")
+            if matrix.shape != (len(doctors), embedder.dim) or built_with != embedder_name(embedder):
+                matrix = None
+        if matrix is None:
+            logger.info(f"Embedding {len(doctors)} doctor profiles from {path}")
+            matrix = embedder.embed([doctor_profile_text(doctor) for doctor in doctors])
+            np.save(matrix_path, matrix)
+            with open(meta_path, "w", encoding="utf-8") as meta_file:
+                json.dump({"embedder": embedder_name(embedder)}, meta_file)
+        return cls(doctors, matrix, embedder)
+
+    def score(self, question):
+        return self.matrix @ self.embedder.embed_one(question)
+
+    def shortlist(self, question, k=3, min_score=0.0):
+        """Up to k best-matching doctors as (score, doctor) pairs, best first.
+
+        Doctors scoring below min_score are left out, so the list may be empty.
+        """
+        if not self.doctors:
+            return []
+        scores = self.score(question)
+        k = min(k, len(self.doctors))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[row]), self.doctors[row]) for row in top if scores[row] >= min_score]
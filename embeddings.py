@@ -0,0 +1,90 @@
+import os
+import threading
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+
+class HashingEmbedder:
+    """Local, stateless text embedder: hashed word and character n-grams.
+
+    Needs no fitting and no network call, so new texts can be embedded one at
+    a time (for incremental upserts) in well under a millisecond. Word 1-2
+    grams capture phrasing, character 3-4 grams tolerate misspellings such as
+    "metfromin". Vectors are float32 and L2-normalised, so a dot product is the
+    cosine similarity. Anything with the same embed(texts) -> array interface,
+    e.g. a wrapper around an embeddings API, can be used in its place.
+
+    Being lexical, it scores questions that differ in one meaningful word
+    ("readings are high" vs "readings are normal") as very similar, and cannot
+    relate symptoms to specialty names; see SentenceTransformerEmbedder.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        # Each half is normalised on its own so both kinds of n-gram weigh the same
+        self._word = HashingVectorizer(n_features=dim // 2, ngram_range=(1, 2), alternate_sign=False, norm="l2", stop_words="english")
+        self._char = HashingVectorizer(n_features=dim - dim // 2, analyzer="char_wb", ngram_range=(3, 4), alternate_sign=False, norm="l2")
+
+    def embed(self, texts):
+        vectors = np.hstack([
+            self._word.transform(texts).toarray(),
+            self._char.transform(texts).toarray()
+        ]).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def embed_one(self, text):
+        return self.embed([text])[0]
+
+
+class SentenceTransformerEmbedder:
+    """Semantic embedder backed by a local sentence-transformers model.
+
+    Relates texts by meaning rather than shared n-grams, e.g. "heart
+    palpitations" to "cardiology", at the cost of loading the model and a few
+    milliseconds per text on CPU. Needs the sentence-transformers package.
+    """
+
+    def __init__(self, model_name):
+        if SentenceTransformer is None:
+            raise ImportError("sentence-transformers is not installed; pip install sentence-transformers to use a semantic embedder")
+        self.name = model_name
+        self._model = SentenceTransformer(model_name)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        return self._model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def embed_one(self, text):
+        return self.embed([text])[0]
+
+
+def embedder_name(embedder):
+    """Identifies the embedder that built stored vectors, so indexes can refuse a different one."""
+    return getattr(embedder, "name", type(embedder).__name__)
+
+
+_semantic_embedders = {}
+_semantic_lock = threading.Lock()
+
+
+def get_embedder(dim=1024):
+    """The sentence-transformers model named by DOCOTOC_EMBEDDING_MODEL, else a HashingEmbedder of dim.
+
+    A semantic model is loaded once per process and shared by every index.
+    """
+    model_name = os.environ.get("DOCOTOC_EMBEDDING_MODEL")
+    if not model_name:
+        return HashingEmbedder(dim)
+    with _semantic_lock:
+        if model_name not in _semantic_embedders:
+            _semantic_embedders[model_name] = SentenceTransformerEmbedder(model_name)
+        return _semantic_embedders[model_name]
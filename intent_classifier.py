@@ -0,0 +1,139 @@
+import re
+import logging
+import threading
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+
+logger = logging.getLogger(__name__)
+
+IN_SCOPE = "doctor_question"
+OUT_OF_SCOPE_INTENTS = ("refill", "scheduling", "billing")
+
+KEYWORDS = {
+    # "prescription" and "pharmacy" alone also appear in side-effect questions,
+    # so they only count next to a request to send something there
+    "refill": re.compile(r"\b(refills?|refilled|renew(al|ed)?|run(ning)? out of|ran out of|need more of|(send|sent|transfer|call)\b[\w' ]{0,40}\bto (the|my) pharmacy)\b", re.I),
+    "scheduling": re.compile(r"\b(appointments?|schedul\w*|reschedul\w*|book(ing)?|cancel\w*|available slots?|next opening)\b", re.I),
+    "billing": re.compile(r"\b(bills?|billing|pay(ing|ment)?|invoice|copay|co-pay|balance|charged?|insurance claim)\b", re.I),
+}
+
+# Seed examples for the TF-IDF model; keywords alone would also fire on
+# in-scope questions such as "my prescription makes me dizzy".
+TRAINING_EXAMPLES = {
+    "refill": [
+        "I need a refill of my metformin",
+        "can you refill my blood pressure prescription",
+        "please renew my prescription",
+        "I ran out of my inhaler, can you send a new one to the pharmacy",
+        "I'm running out of my pills",
+        "send my prescription to the pharmacy",
+        "I need more of my medication",
+        "refill my insulin please",
+    ],
+    "scheduling": [
+        "I want to book an appointment",
+        "can I schedule a visit with my doctor",
+        "I need to reschedule my appointment",
+        "cancel my appointment next week",
+        "when is the next available slot",
+        "set up a follow up visit",
+        "can I see the doctor tomorrow",
+        "change my appointment time",
+    ],
+    "billing": [
+        "I want to pay my bill",
+        "how much do I owe",
+        "I have a question about my invoice",
+        "why was I charged twice",
+        "can I pay my copay online",
+        "what is my account balance",
+        "my insurance claim was denied",
+        "set up a payment plan",
+    ],
+    IN_SCOPE: [
+        "I want to ask my doctor about my blood sugar",
+        "does metformin cause constipation",
+        "should I keep taking calcium supplements",
+        "can I stop my hypertension meds",
+        "is my asthma medication safe during pregnancy",
+        "what are the new options for depression treatment",
+        "can I inherit breast cancer genes",
+        "my joints hurt when I exercise, what should I do",
+        "how often should I check my blood pressure",
+        "I have a question for my doctor",
+        "my new medication makes me feel dizzy",
+        "are these side effects normal for my prescription",
+        "can I take my prescription with other medicines",
+        "is it safe to take ibuprofen with my blood pressure pills",
+        "my prescription upsets my stomach, should I stop it",
+        "the pharmacy gave me a different pill, is it the same medicine",
+        "yes",
+        "no, that's all",
+    ],
+}
+
+CANNED_REPLIES = {
+    "refill": "medication refills",
+    "scheduling": "scheduling appointments",
+    "billing": "bill payment",
+}
+
+
+def canned_reply(intent):
+    return (
+        f"I'm sorry, I am a POC prototype and I can't help with {CANNED_REPLIES[intent]} yet. "
+        "Right now I can help you ask your doctor a question, choose the right doctor, and draft an email to them. "
+        "Is there anything else I can help you with?"
+    )
+
+
+class IntentClassifier:
+    """Local fast path that answers out-of-scope requests without calling GPT-4.
+
+    A turn is answered locally only when the TF-IDF/logistic-regression model is
+    confident it is a refill, scheduling or billing request and a keyword for
+    that intent appears in it (or the model alone is very confident). Anything
+    ambiguous or in scope goes to GPT-4 as before.
+    """
+
+    def __init__(self, confidence=0.6, keywordless_confidence=0.85):
+        self.confidence = confidence
+        self.keywordless_confidence = keywordless_confidence
+        self.calls_saved = 0
+        self._lock = threading.Lock()
+        texts, labels = [], []
+        for intent, examples in TRAINING_EXAMPLES.items():
+            texts.extend(examples)
+            labels.extend([intent] * len(examples))
+        self._model = make_pipeline(
+            TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True),
+            LogisticRegression(C=10, max_iter=1000)
+        )
+        self._model.fit(texts, labels)
+
+    def classify(self, text):
+        """Returns (intent, probability) for the most likely intent."""
+        probabilities = self._model.predict_proba([text])[0]
+        best = probabilities.argmax()
+        return str(self._model.classes_[best]), float(probabilities[best])
+
+    def out_of_scope_intent(self, text):
+        intent, probability = self.classify(text)
+        if intent not in OUT_OF_SCOPE_INTENTS:
+            return None
+        has_keyword = KEYWORDS[intent].search(text) is not None
+        if probability >= self.keywordless_confidence or (has_keyword and probability >= self.confidence):
+            return intent
+        return None
+
+    def fast_reply(self, text):
+        """A canned reply for a confidently out-of-scope turn, else None."""
+        intent = self.out_of_scope_intent(text)
+        if intent is None:
+            return None
+        with self._lock:
+            self.calls_saved += 1
+            calls_saved = self.calls_saved
+        logger.info(f"Answered {intent} request locally ({calls_saved} GPT-4 calls saved)")
+        return canned_reply(intent)
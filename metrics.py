@@ -0,0 +1,140 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Seconds; wide enough for a long Whisper upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+DESCRIPTIONS = {
+    "docotoc_openai_call_seconds": ("histogram", "OpenAI calls from queueing to the last retry, by operation and outcome"),
+    "docotoc_openai_queue_wait_seconds": ("histogram", "Time OpenAI requests waited for the scheduler's rate budget"),
+    "docotoc_openai_first_token_seconds": ("histogram", "Time from starting a streamed OpenAI call to its first token"),
+    "docotoc_openai_retries_total": ("counter", "OpenAI requests retried, by operation and error"),
+    "docotoc_openai_tokens_total": ("counter", "Prompt and completion tokens, by operation"),
+    "docotoc_audio_seconds_total": ("counter", "Seconds of audio sent to Whisper"),
+    "docotoc_cache_lookups_total": ("counter", "Cache lookups, by cache and result"),
+    "docotoc_stage_seconds": ("histogram", "Pipeline stages and request handlers, by stage and outcome"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class _NullSpan:
+    def set_attribute(self, key, value):
+        pass
+
+
+class MetricsRegistry:
+    """Process-wide counters and latency histograms.
+
+    render() returns them in the Prometheus text exposition format. span()
+    times a block into a histogram and, when opentelemetry is installed, also
+    opens a trace span for it; without a configured tracer provider those
+    spans are no-ops.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._tracer = trace.get_tracer("docotoc") if trace is not None else None
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, name, metric="docotoc_stage_seconds", **labels):
+        """Times the block into metric, labelled with outcome="ok" or "error"."""
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            if self._tracer is None:
+                yield _NullSpan()
+            else:
+                with self._tracer.start_as_current_span(name, attributes={key: str(value) for key, value in labels.items()}) as span:
+                    yield span
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(metric, time.perf_counter() - started, outcome=outcome, **labels)
+
+    def snapshot(self):
+        """Counter totals and histogram (count, sum) pairs, keyed by name and labels."""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {key: (histogram[2], histogram[1]) for key, histogram in self._histograms.items()}
+            }
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in DESCRIPTIONS:
+                kind, description = DESCRIPTIONS[name]
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{name}{_format_labels(dict(labels))} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            describe(name)
+            labels = dict(labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+_default_metrics = None
+_default_lock = threading.Lock()
+
+
+def get_metrics():
+    """Process-wide metrics registry shared by the scheduler, caches and pipeline."""
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = MetricsRegistry()
+        return _default_metrics
@@ -0,0 +1,206 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+FILLER_WORDS = "thank you for your question your doctor will review it and get back to you shortly".split()
+
+
+class MockOpenAI:
+    """Local stand-in for the OpenAI chat completions and audio transcription endpoints.
+
+    Replies are canned but shaped like the real API, including streamed chat
+    chunks and usage counts. Every response waits latency seconds (scaled by
+    a random factor within +/- jitter) plus token_delay per completion token,
+    which a streamed reply spends between chunks; transcriptions wait
+    audio_latency plus audio_latency_per_mb of upload. A fraction error_rate
+    of requests is answered with a 429 carrying retry-after-ms.
+    """
+
+    def __init__(self, latency=0.3, token_delay=0.01, audio_latency=0.5, audio_latency_per_mb=0.5, jitter=0.2,
+                 reply_tokens=40, error_rate=0.0, retry_after_ms=200, seed=None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.audio_latency = audio_latency
+        self.audio_latency_per_mb = audio_latency_per_mb
+        self.jitter = jitter
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+        self._random = random.Random(seed)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"chat": 0, "stream": 0, "transcriptions": 0, "rate_limited": 0}
+
+    def build_app(self):
+        app = web.Application(client_max_size=30 * 1024 * 1024)
+        app.add_routes([
+            web.get("/health", self.health),
+            web.post("/v1/chat/completions", self.chat_completions),
+            web.post("/v1/audio/transcriptions", self.transcriptions),
+        ])
+        return app
+
+    def _delay(self, seconds):
+        return seconds * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _rate_limited(self):
+        if self._random.random() >= self.error_rate:
+            return None
+        self.stats["rate_limited"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached (injected by the mock server)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"retry-after-ms": str(self.retry_after_ms)}
+        )
+
+    def _reply(self, payload):
+        messages = payload.get("messages", [])
+        last = messages[-1]["content"] if messages else ""
+        if (payload.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps({"corrected_text": last, "email": f"Dear Doctor,\n\n{last[:300]}\n\nSincerely,\n[Your Name]"})
+        # A confirmation ends the interactive conversation with the question JSON
+        if last.strip().lower().rstrip(".!") in ("yes", "yes please"):
+            question = next((message["content"] for message in reversed(messages[:-1]) if message["role"] == "user"), "my question")
+            return json.dumps({"patient_question": question, "doctor_name": "Dr. Mock", "patient_name": "Patient"})
+        words = [FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(min(self.reply_tokens, payload.get("max_tokens") or self.reply_tokens))]
+        return " ".join(words).capitalize() + "."
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", **self.stats})
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        await asyncio.sleep(self._delay(self.latency))
+        rejected = self._rate_limited()
+        if rejected is not None:
+            return rejected
+
+        content = self._reply(payload)
+        # Whole words stand in for tokens, with the spaces kept on the following word
+        words = content.split(" ")
+        tokens = [words[0]] + [" " + word for word in words[1:]]
+        usage = {
+            "prompt_tokens": sum(len(message["content"]) // 4 + 4 for message in payload.get("messages", [])),
+            "completion_tokens": len(tokens)
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock{self.stats['chat'] + self.stats['stream']}"
+        model = payload.get("model", "gpt-4")
+
+        if not payload.get("stream"):
+            self.stats["chat"] += 1
+            await asyncio.sleep(self._delay(self.token_delay * len(tokens)))
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        self.stats["stream"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        try:
+            await send({"role": "assistant", "content": ""})
+            for token in tokens:
+                await send({"content": token})
+                await asyncio.sleep(self._delay(self.token_delay))
+            await send({}, finish_reason="stop")
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading early, as the app does once the patient question JSON is complete
+            pass
+        return response
+
+    async def transcriptions(self, request):
+        form = await request.post()
+        upload = form.get("file")
+        size = len(upload.file.read()) if upload is not None else 0
+        await asyncio.sleep(self._delay(self.audio_latency + self.audio_latency_per_mb * size / (1024 * 1024)))
+        rejected = self._rate_limited()
+        if rejected is not None:
+            return rejected
+
+        self.stats["transcriptions"] += 1
+        filename = upload.filename if upload is not None else "audio"
+        text = f"Hi doctor, this is a mock transcription of {filename}. Does metformin cause constipation?"
+        if form.get("response_format", "json") == "text":
+            return web.Response(text=text, content_type="text/plain")
+        return web.json_response({"text": text})
+
+
+def start_mock_server(mock, host="127.0.0.1", port=0):
+    """Serve mock from a background thread; returns (base_url, stop)."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(mock.build_app(), access_log=None)
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, name="mock-openai", daemon=True)
+    thread.start()
+    started.wait()
+    bound_host, bound_port = runner.addresses[0][:2]
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return f"http://{bound_host}:{bound_port}/v1", stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat and audio endpoints")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8010, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds before every response starts")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Seconds per completion token")
+    parser.add_argument("--audio-latency", type=float, default=0.5, help="Seconds per transcription, plus --audio-latency-per-mb")
+    parser.add_argument("--audio-latency-per-mb", type=float, default=0.5, help="Extra transcription seconds per MB uploaded")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms sent with injected 429s")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockOpenAI(
+        latency=args.latency,
+        token_delay=args.token_delay,
+        audio_latency=args.audio_latency,
+        audio_latency_per_mb=args.audio_latency_per_mb,
+        error_rate=args.error_rate,
+        retry_after_ms=args.retry_after_ms
+    )
+    logger.info(f"Mock OpenAI API on http://{args.host}:{args.port}/v1 - set OPENAI_BASE_URL to use it")
+    web.run_app(mock.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
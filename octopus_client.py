@@ -0,0 +1,60 @@
+import os
+import time
+import argparse
+import requests
+
+DEFAULT_ROUTER_URL = os.environ.get("OCTOPUS_ROUTER_URL", "http://localhost:8001")
+
+
+class RouterClient:
+    """Talks to a running `octopus_v4_chatbot.py --serve` process.
+
+    Importing this module does not import torch or load any weights, so
+    short-lived workers can route queries without paying the model's start-up
+    cost. The session keeps its HTTP connection alive between queries.
+    """
+
+    def __init__(self, url=DEFAULT_ROUTER_URL, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def route(self, question):
+        response = self._session.post(f"{self.url}/route", json={"question": question}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def is_ready(self):
+        try:
+            response = self._session.get(f"{self.url}/health", timeout=5)
+        except requests.RequestException:
+            return False
+        return response.ok and response.json().get("status") == "ready"
+
+    def wait_until_ready(self, timeout=300, interval=1.0):
+        deadline = time.monotonic() + timeout
+        while not self.is_ready():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Octopus router at {self.url} not ready after {timeout}s")
+            time.sleep(interval)
+
+
+def chatbot(client):
+    print("Chatbot: Hello! I'm the Octopus-v4 router. How can I assist you today? (Type 'exit' to end the conversation)")
+    while True:
+        user_input = input("You: ")
+        if user_input.lower() == 'exit':
+            print("Chatbot: Goodbye!")
+            break
+        response = client.route(user_input)
+        print("Chatbot:", response)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with a running Octopus-v4 routing server")
+    parser.add_argument("--url", default=DEFAULT_ROUTER_URL)
+    args = parser.parse_args()
+
+    router = RouterClient(args.url)
+    router.wait_until_ready()
+    chatbot(router)
@@ -1,29 +1,423 @@
+import os
+import re
+import gc
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
-# Load the model and tokenizer
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 model_name = "NexaAIDev/Octopus-v4"
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    device_map="auto",
-    torch_dtype=torch.bfloat16,
-    trust_remote_code=True
-)
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-def generate_response(question):
-    inputs = f"<|system|>You are a router. Below is the query from the users, please call the correct function and generate the parameters to call the function.<|end|><|user|>{question}<|end|><|assistant|>"
-    input_ids = tokenizer(inputs, return_tensors="pt")['input_ids'].to(model.device)
-    generated_token_ids = []
-
-    for _ in range(200):
-        next_token = model(input_ids).logits[:, -1].argmax(-1)
-        generated_token_ids.append(next_token.item())
-        input_ids = torch.cat([input_ids, next_token.unsqueeze(1)], dim=-1)
-        if next_token.item() == 32041:  # <nexa_end> token
+model = None
+tokenizer = None
+_load_lock = threading.Lock()
+
+NEXA_END_TOKEN_ID = 32041  # <nexa_end> token
+MAX_NEW_TOKENS = int(os.environ.get("OCTOPUS_MAX_NEW_TOKENS", 200))
+
+# Inference profile, see build_model: "default", "cpu" or "full"
+PROFILE = os.environ.get("OCTOPUS_PROFILE", "default")
+CPU_THREADS = int(os.environ.get("OCTOPUS_THREADS", 0))
+COMPILE_MODEL = os.environ.get("OCTOPUS_COMPILE", "0") == "1"
+# Kept in float32 by the cpu profile: the output projection picks the function token
+UNQUANTIZED_MODULES = ("lm_head",)
+
+FUNCTION_TOKEN_PATTERN = re.compile(r"<nexa_\d+>")
+ACCURACY_QUESTIONS = [
+    "Tell me the result of derivative of x^3 when x is 2?",
+    "What is the speed of light in a vacuum?",
+    "How do vaccines train the immune system?",
+    "What are the side effects of metformin?",
+    "Can a landlord keep my security deposit for normal wear and tear?",
+    "What caused the fall of the Roman Empire?",
+    "How do I reverse a linked list in Python?",
+    "What is the difference between stocks and bonds?",
+    "Why is the sky blue?",
+    "What does the mitochondria do in a cell?",
+]
+
+def load_tokenizer():
+    global tokenizer
+    if tokenizer is None:
+        loaded = AutoTokenizer.from_pretrained(model_name)
+        # Batched prompts are left-padded so every row's last position is its newest token
+        loaded.padding_side = "left"
+        if loaded.pad_token is None:
+            loaded.pad_token = loaded.eos_token
+        tokenizer = loaded
+    return tokenizer
+
+def quantize_linear_layers(module, skip=UNQUANTIZED_MODULES, prefix=""):
+    """Swap nn.Linear layers for dynamically quantized int8 ones, in place.
+
+    Each layer is upcast to float32 just before it is quantized, so a float32
+    copy of the whole model never exists at once.
+    """
+    for name, child in module.named_children():
+        path = prefix + name
+        if path in skip:
+            continue
+        if isinstance(child, torch.nn.Linear):
+            child = child.float()
+            child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+            setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+        else:
+            quantize_linear_layers(child, skip, path + ".")
+    return module
+
+def build_model(profile=PROFILE, compile_model=COMPILE_MODEL, threads=CPU_THREADS):
+    """Load the weights for an inference profile.
+
+    "default" keeps the bf16 checkpoint and lets accelerate place it
+    (device_map="auto"). "cpu" is for nodes without a GPU, where bf16 matmuls
+    are slow: Linear layers except lm_head become dynamically quantized int8
+    and everything else float32; compile_model wraps forward in torch.compile.
+    "full" is unquantized float32 on the CPU, the reference the cpu profile is
+    checked against. threads sets torch's intra-op thread count for the CPU
+    profiles. Safetensors weights are memory-mapped (low_cpu_mem_usage)
+    rather than first materialised as a full copy in RAM.
+    """
+    if profile not in ("default", "cpu", "full"):
+        raise ValueError(f"Unknown inference profile {profile!r}")
+    started = time.perf_counter()
+    if profile != "default" and threads:
+        torch.set_num_threads(threads)
+    loaded = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        device_map="auto" if profile == "default" else None,
+        torch_dtype=torch.bfloat16 if profile != "full" else torch.float32,
+        trust_remote_code=True,
+        low_cpu_mem_usage=True
+    )
+    loaded.eval()
+    if profile == "cpu":
+        quantize_linear_layers(loaded)
+        loaded.float()
+        if compile_model:
+            loaded.forward = torch.compile(loaded.forward, dynamic=True)
+    logger.info(f"Loaded {model_name} ({profile} profile, {torch.get_num_threads()} threads) in {time.perf_counter() - started:.1f}s")
+    return loaded
+
+def load_model(profile=None, compile_model=None, threads=None):
+    """Load the model and tokenizer on first use instead of at import time.
+
+    Arguments left as None fall back to OCTOPUS_PROFILE, OCTOPUS_COMPILE and
+    OCTOPUS_THREADS; only the first call's settings take effect.
+    """
+    global model
+    with _load_lock:
+        if model is None:
+            load_tokenizer()
+            model = build_model(
+                PROFILE if profile is None else profile,
+                COMPILE_MODEL if compile_model is None else compile_model,
+                CPU_THREADS if threads is None else threads
+            )
+    return model, tokenizer
+
+def warm_up():
+    """Run one short generation so the first real query does not pay for lazy initialisation."""
+    started = time.perf_counter()
+    generate_batch(["warm up"], max_new_tokens=4)
+    logger.info(f"Warm-up generation took {time.perf_counter() - started:.1f}s")
+
+def build_prompt(question):
+    return f"<|system|>You are a router. Below is the query from the users, please call the correct function and generate the parameters to call the function.<|end|><|user|>{question}<|end|><|assistant|>"
+
+@torch.inference_mode()
+def generate_response(question, max_new_tokens=MAX_NEW_TOKENS):
+    load_model()
+    input_ids = tokenizer(build_prompt(question), return_tensors="pt")['input_ids'].to(model.device)
+    generated_token_ids = torch.empty(max_new_tokens, dtype=torch.long)
+    num_generated = 0
+
+    # The prompt is run once; every later step feeds only the newest token and
+    # reuses the cached keys/values instead of re-running the whole sequence.
+    past_key_values = None
+    for _ in range(max_new_tokens):
+        outputs = model(input_ids, past_key_values=past_key_values, use_cache=True)
+        past_key_values = outputs.past_key_values
+        next_token = outputs.logits[:, -1].argmax(-1)
+        token_id = next_token.item()
+        generated_token_ids[num_generated] = token_id
+        num_generated += 1
+        if token_id == NEXA_END_TOKEN_ID:
+            break
+        input_ids = next_token.unsqueeze(1)
+
+    return tokenizer.decode(generated_token_ids[:num_generated].tolist())
+
+def select_cache_rows(past_key_values, rows):
+    if hasattr(past_key_values, "batch_select_indices"):
+        past_key_values.batch_select_indices(rows)
+        return past_key_values
+    return tuple(tuple(tensor[rows] for tensor in layer) for layer in past_key_values)
+
+def generate_batch(questions, max_new_tokens=MAX_NEW_TOKENS):
+    """Greedy-decode several questions in one padded batch."""
+    load_model()
+    return [tokenizer.decode(token_ids) for token_ids in decode_batch(model, questions, max_new_tokens)]
+
+@torch.inference_mode()
+def decode_batch(lm, questions, max_new_tokens=MAX_NEW_TOKENS):
+    """Generated token ids of each question, greedy-decoded by lm in one padded batch.
+
+    Rows that emit <nexa_end> are dropped from the batch (and from the KV
+    cache) right away, so the remaining rows decode without carrying them.
+    """
+    encoded = tokenizer([build_prompt(question) for question in questions], return_tensors="pt", padding=True)
+    input_ids = encoded["input_ids"].to(lm.device)
+    prompt_mask = encoded["attention_mask"].to(lm.device)
+    batch_size, prompt_length = input_ids.shape
+
+    attention_mask = torch.ones(batch_size, prompt_length + max_new_tokens, dtype=prompt_mask.dtype, device=lm.device)
+    attention_mask[:, :prompt_length] = prompt_mask
+    position_ids = (prompt_mask.cumsum(-1) - 1).clamp(min=0)
+    generated_token_ids = torch.empty(batch_size, max_new_tokens, dtype=torch.long)
+    num_generated = torch.zeros(batch_size, dtype=torch.long)
+    active = torch.arange(batch_size)  # original row of each sequence still decoding
+
+    past_key_values = None
+    for step in range(max_new_tokens):
+        outputs = lm(
+            input_ids,
+            attention_mask=attention_mask[:, :prompt_length + step],
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+        past_key_values = outputs.past_key_values
+        next_tokens = outputs.logits[:, -1].argmax(-1)
+        next_token_ids = next_tokens.cpu()
+        generated_token_ids[active, step] = next_token_ids
+        num_generated[active] += 1
+
+        finished = next_token_ids == NEXA_END_TOKEN_ID
+        if finished.all():
             break
+        if finished.any():
+            keep = (~finished).nonzero().squeeze(1)
+            active = active[keep]
+            keep = keep.to(lm.device)
+            next_tokens = next_tokens[keep]
+            attention_mask = attention_mask[keep]
+            position_ids = position_ids[keep]
+            past_key_values = select_cache_rows(past_key_values, keep)
+        input_ids = next_tokens.unsqueeze(1)
+        position_ids = position_ids[:, -1:] + 1
 
-    return tokenizer.decode(generated_token_ids)
+    return [generated_token_ids[row, :num_generated[row]].tolist() for row in range(batch_size)]
+
+class RoutingService:
+    """Routes queries from many threads through shared batched forward passes.
+
+    Queries are queued and a single worker thread takes up to max_batch_size
+    of them, waiting at most max_wait seconds after the first one for the
+    batch to fill, then decodes them together with generate_batch.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait=0.02, max_new_tokens=MAX_NEW_TOKENS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="octopus-router", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, question):
+        future = Future()
+        self._queue.put((question, future))
+        return future
+
+    def route(self, question, timeout=None):
+        return self.submit(question).result(timeout)
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then let the worker see the stop signal
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [(question, future) for question, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                responses = generate_batch([question for question, _ in batch], self.max_new_tokens)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), response in zip(batch, responses):
+                future.set_result(response)
+
+class RouterRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so clients reuse their connection
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ready", "model": model_name})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/route":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            question = json.loads(self.rfile.read(length))["question"]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": "expected a JSON body with a 'question'"})
+            return
+        try:
+            response = self.server.routing_service.route(question)
+        except Exception as e:
+            logger.error(f"Routing failed: {str(e)}")
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"response": response})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve(host="0.0.0.0", port=8001, max_batch_size=8, max_wait=0.02, profile=None, compile_model=None, threads=None):
+    """Load the weights once, warm up, then serve /route and /health until interrupted."""
+    load_model(profile, compile_model, threads)
+    warm_up()
+    routing_service = RoutingService(max_batch_size=max_batch_size, max_wait=max_wait).start()
+    server = ThreadingHTTPServer((host, port), RouterRequestHandler)
+    server.daemon_threads = True
+    server.routing_service = routing_service
+    logger.info(f"Octopus-v4 router ready on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        routing_service.stop()
+
+def resident_memory_mb():
+    """Resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+def routed_function(output):
+    """The <nexa_N> function token a router output calls, which is what decides the route."""
+    match = FUNCTION_TOKEN_PATTERN.search(output)
+    return match.group(0) if match else output.split("(")[0].strip()
+
+def profile_run(profile, questions, max_new_tokens, compile_model, threads):
+    """Outputs, per-token latency and resident memory of one profile, decoding questions one at a time."""
+    gc.collect()
+    memory_before = resident_memory_mb()
+    lm = build_model(profile, compile_model, threads)
+    memory_after = resident_memory_mb()
+    decode_batch(lm, questions[:1], max_new_tokens=4)  # warm-up, and compilation with compile_model
+
+    outputs, tokens, elapsed = [], 0, 0.0
+    for question in questions:
+        started = time.perf_counter()
+        token_ids = decode_batch(lm, [question], max_new_tokens)[0]
+        elapsed += time.perf_counter() - started
+        tokens += len(token_ids)
+        outputs.append(tokenizer.decode(token_ids))
+    del lm
+    gc.collect()
+    return {
+        "outputs": outputs,
+        "ms_per_token": elapsed / max(tokens, 1) * 1000,
+        "resident_mb": memory_after - memory_before if memory_before is not None else None
+    }
+
+def check_routing_accuracy(questions=ACCURACY_QUESTIONS, max_new_tokens=MAX_NEW_TOKENS, compile_model=False, threads=CPU_THREADS):
+    """Compare the cpu profile's routing with the full-precision model on questions.
+
+    The two models are loaded one after the other, so peak memory is the
+    float32 model's. Returns the fraction of questions routed to the same
+    function, the fraction with identical output, the mismatches and each
+    profile's per-token latency and resident memory.
+    """
+    load_tokenizer()
+    reference = profile_run("full", questions, max_new_tokens, False, threads)
+    candidate = profile_run("cpu", questions, max_new_tokens, compile_model, threads)
+    pairs = list(zip(questions, reference.pop("outputs"), candidate.pop("outputs")))
+    same_route = [routed_function(expected) == routed_function(actual) for _, expected, actual in pairs]
+    return {
+        "routing_agreement": sum(same_route) / len(pairs),
+        "exact_match": sum(expected == actual for _, expected, actual in pairs) / len(pairs),
+        "mismatches": [
+            {"question": question, "full": expected, "cpu": actual}
+            for (question, expected, actual), routed_alike in zip(pairs, same_route) if not routed_alike
+        ],
+        "full": reference,
+        "cpu": candidate
+    }
+
+def run_accuracy_check(questions_path=None, min_agreement=1.0, compile_model=False, threads=CPU_THREADS):
+    questions = ACCURACY_QUESTIONS
+    if questions_path:
+        with open(questions_path, "r", encoding="utf-8") as questions_file:
+            questions = [line.strip() for line in questions_file if line.strip()]
+    report = check_routing_accuracy(questions, compile_model=compile_model, threads=threads)
+    for profile in ("full", "cpu"):
+        stats = report[profile]
+        memory = f"{stats['resident_mb']:.0f} MB" if stats["resident_mb"] is not None else "n/a"
+        print(f"{profile:<5} {stats['ms_per_token']:8.1f} ms/token  resident {memory}")
+    print(f"Routing agreement {report['routing_agreement']:.0%}, identical output {report['exact_match']:.0%} over {len(questions)} questions")
+    for mismatch in report["mismatches"]:
+        print(f"- {mismatch['question']}\n    full: {mismatch['full']}\n    cpu:  {mismatch['cpu']}")
+    return report["routing_agreement"] >= min_agreement
 
 def chatbot():
     print("Chatbot: Hello! I'm the Octopus-v4 router. How can I assist you today? (Type 'exit' to end the conversation)")
@@ -35,5 +429,29 @@ def chatbot():
         response = generate_response(user_input)
         print("Chatbot:", response)
 
+def main():
+    parser = argparse.ArgumentParser(description="Octopus-v4 router")
+    parser.add_argument("--serve", action="store_true", help="Run the long-lived routing server instead of the chatbot")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("OCTOPUS_PORT", 8001)))
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait", type=float, default=0.02, help="Seconds to wait for a batch to fill")
+    parser.add_argument("--profile", choices=["default", "cpu", "full"], default=PROFILE, help="Inference profile; cpu quantizes Linear layers to int8 for GPU-less nodes")
+    parser.add_argument("--compile", action="store_true", default=COMPILE_MODEL, help="Compile the forward pass with torch.compile (cpu profile)")
+    parser.add_argument("--threads", type=int, default=CPU_THREADS, help="torch threads for the CPU profiles (0 keeps torch's default)")
+    parser.add_argument("--check-accuracy", action="store_true", help="Compare the cpu profile's routing with the full-precision model and exit")
+    parser.add_argument("--questions", help="File of questions, one per line, for --check-accuracy")
+    parser.add_argument("--min-agreement", type=float, default=1.0, help="Routing agreement below which --check-accuracy fails")
+    args = parser.parse_args()
+
+    if args.check_accuracy:
+        if not run_accuracy_check(args.questions, args.min_agreement, compile_model=args.compile, threads=args.threads):
+            raise SystemExit(1)
+    elif args.serve:
+        serve(args.host, args.port, max_batch_size=args.max_batch_size, max_wait=args.max_wait, profile=args.profile, compile_model=args.compile, threads=args.threads)
+    else:
+        load_model(args.profile, args.compile, args.threads)
+        chatbot()
+
 if __name__ == "__main__":
-    chatbot()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,9 +1,31 @@
 import os
 import time
 import json
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import logging
-from openai import OpenAI, RateLimitError
+import httpx
+from aiohttp import web
+from openai import OpenAI, AsyncOpenAI, OpenAIError
+from transcription_cache import TranscriptionCache, audio_cache_key, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from streaming import IncrementalJsonDetector, consume_stream, print_token
+from conversation import ConversationContext, shared_token_counter
+from scheduler import get_scheduler, estimate_chat_tokens, INTERACTIVE, BATCH
+from audio_chunking import needs_chunking, transcribe_chunked, probe_duration, WHISPER_MAX_UPLOAD_BYTES
+from audio_preprocessing import preprocess_audio
+from answer_index import AnswerIndex, DEFAULT_INDEX_DIR
+from doctor_matching import DoctorMatcher, DEFAULT_DIRECTORY_PATH
+from intent_classifier import IntentClassifier
+from response_cache import ResponseCache, response_cache_key, prompt_version, DEFAULT_DB_PATH
+from metrics import get_metrics
+from batch_manifest import BatchManifest, expand_audio_paths
+from session_store import SessionStore, DEFAULT_TTL as DEFAULT_SESSION_TTL, DEFAULT_MAX_BYTES as DEFAULT_SESSION_MAX_BYTES
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,87 +34,87 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file
 load_dotenv()
 
-def get_api_key():
-    api_key = os.environ.get('OPENAI_API_KEY')
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable is not set")
-    return api_key
+AUDIO_DIR = "audio_files"
+AUDIO_FILES = [
+    "0_Blood Sugar Monitoring Guidelines.mp3",
+    "1_Calcium Supplements_ Stay or Go_.mp3",
+    "2_Managing Daily Tasks with Alzheimer's.mp3",
+    "3_Can I Stop My Hypertension Meds_.mp3",
+    "4_Asthma Meds in Pregnancy_ Safety Guide.mp3",
+    "5_Metformin and Constipation Concerns.mp3",
+    "6_New Options for Depression Treatment.mp3",
+    "7_Breast Cancer Gene Inheritance Risks.mp3",
+    "8_Monitoring Your Heart Health.mp3",
+    "9_Managing Arthritis and Exercise Pain.mp3"
+]
 
-def transcribe_with_retry(client, file_path, max_retries=3):
-    for attempt in range(max_retries):
-        try:
-            with open(file_path, "rb") as audio_file:
-                return client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="text"
-                )
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to transcribe.")
-                raise e
+# Recordings in batch mode carry no doctor or patient name, so the email is
+# drafted with generic placeholders the patient fills in before sending.
+BATCH_DOCTOR_NAME = "Doctor"
+BATCH_PATIENT_NAME = "[Your Name]"
+
+TRANSCRIPTION_MODEL = "whisper-1"
+TRANSCRIPTION_FORMAT = "text"
+# Cache variant for transcriptions of preprocessed audio; bump when preprocessing changes
+PREPROCESSED_VARIANT = "preprocessed-v1"
+
+# Previous doctor-patient communications; a question this similar to one of
+# them is offered back to the patient without calling GPT-4. The default
+# embedder is lexical and a one-word change of meaning ("readings are high"
+# vs "normal") still scores about 0.85, so only near-verbatim repeats match
+ANSWER_INDEX_DIR = os.environ.get("DOCOTOC_ANSWER_INDEX", DEFAULT_INDEX_DIR)
+ANSWER_MATCH_THRESHOLD = float(os.environ.get("DOCOTOC_ANSWER_THRESHOLD", 0.95))
+# Short turns such as "yes" are part of the conversation, not questions
+ANSWER_MIN_WORDS = 4
+
+# Directory of doctors (JSONL of {"name", "specialty", "profile"}) to suggest from
+DOCTOR_DIRECTORY_PATH = os.environ.get("DOCOTOC_DOCTOR_DIRECTORY", DEFAULT_DIRECTORY_PATH)
+DOCTOR_SHORTLIST_SIZE = 3
+# Doctors scoring below this are left out of the prompt rather than offered as
+# matches; calibrated for the hashed embedder, whose unrelated profiles score
+# around 0.4. Raise it when DOCOTOC_EMBEDDING_MODEL selects a semantic model
+DOCTOR_MATCH_THRESHOLD = float(os.environ.get("DOCOTOC_DOCTOR_THRESHOLD", 0.45))
+
+# Token budget for the conversation history sent with every interactive turn
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("DOCOTOC_CONTEXT_TOKENS", 1500))
 
-def correct_spelling(client, transcription, max_retries=3):
-    system_prompt = """
+# HTTP API (open-ai-app.py serve); all sessions share one pool of keep-alive
+# connections to OpenAI, so the scheduler, not the pool, is the usual limit
+API_PORT = int(os.environ.get("DOCOTOC_PORT", 8000))
+API_MAX_CONNECTIONS = int(os.environ.get("DOCOTOC_API_CONNECTIONS", 100))
+API_MAX_UPLOAD_BYTES = 25 * 1024 * 1024  # Whisper's upload limit
+
+SPELLING_SYSTEM_PROMPT = """
     You are a helpful assistant specializing in medical terminology. 
     Your task is to correct any spelling discrepancies in the transcribed text about blood sugar checks. 
     Make sure that medical terms and procedures are spelled correctly. 
     Only add necessary punctuation such as periods, commas, and capitalization, and use only the context provided.
     """
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": transcription}
-                ]
-            )
-            return response.choices[0].message.content
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to correct spelling.")
-                raise e
+EMAIL_SYSTEM_PROMPT = "You are a helpful assistant that writes concise emails."
+EMAIL_PROMPT_TEMPLATE = """
+    Please draft an email to {doctor_name} regarding the following question:
+    
+    Dear {doctor_name},
 
-# def generate_email(client, corrected_text, max_retries=3):
-    prompt = f"""
-    Please use the following question to generate an email to my doctor. 
-    Please limit the message to 450 characters:
+    {patient_question}
 
-    {corrected_text}
+    Sincerely,
+    {patient_name}
     """
+EMAIL_MAX_TOKENS = 150  # Approximately 450 characters
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that writes concise emails."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=150  # Approximately 450 characters
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to generate email.")
-                raise e
+# JSON mode needs a model that supports response_format
+FUSED_MODEL = os.environ.get("DOCOTOC_FUSED_MODEL", "gpt-4-1106-preview")
+FUSED_MAX_EMAIL_CHARS = 600  # Asked for 450, with some slack before falling back
+FUSED_SYSTEM_PROMPT = SPELLING_SYSTEM_PROMPT + f"""
+    Then use the corrected text as the patient's question and write a concise email to their doctor asking it.
+    The email starts with "Dear {BATCH_DOCTOR_NAME}," and is signed "{BATCH_PATIENT_NAME}". Please limit the email to 450 characters.
 
-# def handle_patient_interaction(client, user_input, max_retries=3):
-    system_prompt = """
+    Respond with a JSON object of the form {{"corrected_text": "The corrected transcription", "email": "The email"}} and nothing else.
+    """
+
+PATIENT_SYSTEM_PROMPT = """
     You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
 
     Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
@@ -101,390 +123,924 @@ def correct_spelling(client, transcription, max_retries=3):
 
     If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, just output a JSON file showing the patient's question. Then you can stop. Please do not say anything else.
+    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, respond with a JSON object containing the patient's question and the doctor's name. The JSON should be in the format: {"patient_question": "The patient's question here", "doctor_name": "Dr. Name", "patient_name": "Patient Name"}. Do not say anything else after outputting the JSON.
     """
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_input}
-                ]
+def get_api_key():
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    return api_key
+
+def get_transcription_cache():
+    cache_dir = os.environ.get("DOCOTOC_CACHE_DIR", DEFAULT_CACHE_DIR)
+    max_mb = int(os.environ.get("DOCOTOC_CACHE_MAX_MB", DEFAULT_MAX_BYTES // (1024 * 1024)))
+    return TranscriptionCache(cache_dir, max_bytes=max_mb * 1024 * 1024)
+
+def request_transcription(client, file_path, max_retries=None, priority=BATCH):
+    def request():
+        with open(file_path, "rb") as audio_file:
+            return client.audio.transcriptions.create(
+                model=TRANSCRIPTION_MODEL,
+                file=audio_file,
+                response_format=TRANSCRIPTION_FORMAT
             )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
 
-# def handle_patient_interaction(client, user_input, max_retries=3):
-    system_prompt = """
-    You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
+    transcription = get_scheduler().call(request, priority=priority, max_retries=max_retries, description="transcription")
+    return transcription if isinstance(transcription, str) else transcription.text
 
-    Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
+def record_audio_seconds(file_path, seconds=None):
+    """Count a transcribed file's audio; seconds, when already known, saves an ffprobe run."""
+    if seconds is None:
+        try:
+            seconds = probe_duration(file_path)
+        except Exception as e:
+            logger.debug(f"Could not measure the duration of {file_path}: {str(e)}")
+            return
+    get_metrics().increment("docotoc_audio_seconds_total", seconds)
 
-    You will not handle medication refills. You will not handle scheduling. You will not handle bill payment. 
+def record_stream(operation, started, stream_stats, messages):
+    """Time to first token and token counts of a consumed stream, which reports no usage."""
+    metrics = get_metrics()
+    if "first_token" in stream_stats:
+        metrics.observe("docotoc_openai_first_token_seconds", stream_stats["first_token"] - started, operation=operation)
+    counter = shared_token_counter()
+    prompt_tokens = sum(counter.count_message(message["content"]) for message in messages)
+    metrics.increment("docotoc_openai_tokens_total", prompt_tokens, operation=operation, kind="prompt")
+    # Each streamed content chunk carries one token
+    metrics.increment("docotoc_openai_tokens_total", stream_stats.get("chunks", 0), operation=operation, kind="completion")
 
-    If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
+def transcribe_with_retry(client, file_path, max_retries=None, cache=None, priority=BATCH, chunked=False, chunk_workers=4, preprocess=False, on_preprocessed=None):
+    """Transcribe file_path with Whisper.
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, just output a JSON file showing the patient's question. Then you can stop. Please do not say anything else.
+    preprocess trims silence and uploads a compact 16 kHz mono Opus copy
+    instead of the original; on_preprocessed, if given, receives the bytes and
+    seconds saved.
     """
+    cache_key = None
+    if cache is not None:
+        variant = PREPROCESSED_VARIANT if preprocess else ""
+        cache_key = audio_cache_key(file_path, TRANSCRIPTION_MODEL, TRANSCRIPTION_FORMAT, variant)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Transcription cache hit for {file_path}")
+            return cached
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_input}
-                ]
+    with tempfile.TemporaryDirectory(prefix="docotoc-audio-") as work_dir:
+        upload_path = file_path
+        audio_seconds = None
+        if preprocess:
+            upload_path, stats = preprocess_audio(file_path, work_dir)
+            audio_seconds = stats["processed_seconds"]
+            if on_preprocessed is not None:
+                on_preprocessed(stats)
+
+        # Recordings over Whisper's upload limit can only be sent in chunks
+        if chunked or os.path.getsize(upload_path) > WHISPER_MAX_UPLOAD_BYTES:
+            chunked = needs_chunking(upload_path)
+        if chunked:
+            transcription = transcribe_chunked(
+                upload_path,
+                lambda chunk_path: request_transcription(client, chunk_path, max_retries, priority),
+                workers=chunk_workers
             )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
+        else:
+            transcription = request_transcription(client, upload_path, max_retries, priority)
+        # Counted once per file; the overlap between chunks is not included
+        record_audio_seconds(upload_path, audio_seconds)
 
-# def handle_patient_interaction(client, user_input, conversation_history, max_retries=3):
-    system_prompt = """
-    You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
+    if cache is not None:
+        cache.put(cache_key, transcription)
+    return transcription
 
-    Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
+def get_session_store():
+    # Sessions live in memory only unless DOCOTOC_SESSION_DB names a SQLite file
+    ttl_minutes = float(os.environ.get("DOCOTOC_SESSION_TTL_MINUTES", DEFAULT_SESSION_TTL / 60))
+    max_mb = float(os.environ.get("DOCOTOC_SESSION_MAX_MB", DEFAULT_SESSION_MAX_BYTES / (1024 * 1024)))
+    return SessionStore(
+        ttl=ttl_minutes * 60,
+        max_bytes=int(max_mb * 1024 * 1024),
+        db_path=os.environ.get("DOCOTOC_SESSION_DB") or None,
+        context_options={"max_tokens": CONTEXT_TOKEN_BUDGET}
+    )
 
-    You will not handle medication refills. You will not handle scheduling. You will not handle bill payment. 
+def get_response_cache():
+    # An empty DOCOTOC_RESPONSE_CACHE_DB keeps the cache in memory only
+    db_path = os.environ.get("DOCOTOC_RESPONSE_CACHE_DB", DEFAULT_DB_PATH)
+    ttl_hours = float(os.environ.get("DOCOTOC_RESPONSE_CACHE_TTL_HOURS", 24 * 7))
+    max_entries = int(os.environ.get("DOCOTOC_RESPONSE_CACHE_ENTRIES", 1024))
+    return ResponseCache(max_entries=max_entries, ttl=ttl_hours * 3600, db_path=db_path or None)
 
-    If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
+# Prompts and cache keys are shared by the blocking functions used by the CLI
+# and their *_async counterparts used by the HTTP API
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, respond with a JSON object containing the patient's question. The JSON should be in the format: {"patient_question": "The patient's question here"}. Do not say anything else after outputting the JSON.
-    """
+def spelling_messages(transcription):
+    return [
+        {"role": "system", "content": SPELLING_SYSTEM_PROMPT},
+        {"role": "user", "content": transcription}
+    ]
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    *conversation_history,
-                    {"role": "user", "content": user_input}
-                ]
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
+def spelling_cache_key(transcription):
+    return response_cache_key("spelling", "gpt-4", prompt_version(SPELLING_SYSTEM_PROMPT), transcription)
 
-# def handle_patient_interaction(client, user_input, conversation_history, max_retries=3):
-    system_prompt = """
-    You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
+def email_messages(patient_question, doctor_name, patient_name):
+    prompt = EMAIL_PROMPT_TEMPLATE.format(doctor_name=doctor_name, patient_question=patient_question, patient_name=patient_name)
+    return [
+        {"role": "system", "content": EMAIL_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
 
-    Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
+def email_cache_key(patient_question, doctor_name, patient_name):
+    version = prompt_version(EMAIL_SYSTEM_PROMPT, EMAIL_PROMPT_TEMPLATE, str(EMAIL_MAX_TOKENS))
+    return response_cache_key("email", "gpt-4", version, patient_question, doctor_name, patient_name)
 
-    You will not handle medication refills. You will not handle scheduling. You will not handle bill payment. 
+def correct_spelling(client, transcription, max_retries=None, priority=BATCH, cache=None):
+    cache_key = None
+    if cache is not None:
+        cache_key = spelling_cache_key(transcription)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
+    messages = spelling_messages(transcription)
+    response = get_scheduler().call(
+        lambda: client.chat.completions.create(model="gpt-4", messages=messages),
+        priority=priority,
+        estimated_tokens=estimate_chat_tokens(messages, max_tokens=len(transcription) // 3),
+        max_retries=max_retries,
+        description="spelling correction"
+    )
+    corrected_text = response.choices[0].message.content
+    if cache is not None:
+        cache.put(cache_key, corrected_text)
+    return corrected_text
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, respond with a JSON object containing the patient's question and the doctor's name. The JSON should be in the format: {"patient_question": "The patient's question here", "doctor_name": "Dr. Name"}. Do not say anything else after outputting the JSON.
-    """
+def generate_email(client, patient_question, doctor_name, patient_name, max_retries=None, stream=False, on_token=None, priority=INTERACTIVE, cache=None):
+    cache_key = None
+    if cache is not None:
+        cache_key = email_cache_key(patient_question, doctor_name, patient_name)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if stream and on_token is not None:
+                on_token(cached)
+            return cached
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    *conversation_history,
-                    {"role": "user", "content": user_input}
-                ]
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
+    messages = email_messages(patient_question, doctor_name, patient_name)
 
-# def generate_email(client, patient_question, doctor_name, max_retries=3):
-    prompt = f"""
-    Please draft an email to {doctor_name} regarding the following question:
-    
-    Dear {doctor_name},
+    started = time.perf_counter()
+    response = get_scheduler().call(
+        lambda: client.chat.completions.create(
+            model="gpt-4",
+            messages=messages,
+            max_tokens=EMAIL_MAX_TOKENS,
+            stream=stream
+        ),
+        priority=priority,
+        estimated_tokens=estimate_chat_tokens(messages, max_tokens=EMAIL_MAX_TOKENS),
+        max_retries=max_retries,
+        description="email generation"
+    )
+    if stream:
+        stream_stats = {}
+        email_content = consume_stream(response, on_token, stats=stream_stats).strip()
+        record_stream("email generation", started, stream_stats, messages)
+    else:
+        email_content = response.choices[0].message.content.strip()
+    if cache is not None:
+        cache.put(cache_key, email_content)
+    return email_content
 
-    {patient_question}
 
-    Thank you,
-    [Your Name]
+def parse_fused_response(content):
+    """Validate the fused JSON reply; returns (corrected_text, email) or raises ValueError."""
+    payload = json.loads(content)
+    if not isinstance(payload, dict) or set(payload) != {"corrected_text", "email"}:
+        raise ValueError("expected exactly the keys corrected_text and email")
+    corrected_text, email_content = payload["corrected_text"], payload["email"]
+    if not isinstance(corrected_text, str) or not corrected_text.strip():
+        raise ValueError("corrected_text must be a non-empty string")
+    if not isinstance(email_content, str) or not email_content.strip():
+        raise ValueError("email must be a non-empty string")
+    if len(email_content) > FUSED_MAX_EMAIL_CHARS:
+        raise ValueError(f"email is {len(email_content)} characters long")
+    return corrected_text, email_content.strip()
+
+def correct_and_draft_email(client, transcription, max_retries=None, priority=BATCH, cache=None):
+    """Spelling correction and email drafting in one JSON-mode round trip.
+
+    Returns (corrected_text, email). If the reply does not validate, falls back
+    to correct_spelling followed by generate_email.
     """
+    cache_key = None
+    if cache is not None:
+        cache_key = response_cache_key("fused", FUSED_MODEL, prompt_version(FUSED_SYSTEM_PROMPT), transcription)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return parse_fused_response(cached)
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that writes concise emails."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=150  # Approximately 450 characters
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to generate email.")
-                raise e
+    messages = [
+        {"role": "system", "content": FUSED_SYSTEM_PROMPT},
+        {"role": "user", "content": transcription}
+    ]
+    response = get_scheduler().call(
+        lambda: client.chat.completions.create(
+            model=FUSED_MODEL,
+            messages=messages,
+            response_format={"type": "json_object"}
+        ),
+        priority=priority,
+        estimated_tokens=estimate_chat_tokens(messages, max_tokens=len(transcription) // 3 + EMAIL_MAX_TOKENS),
+        max_retries=max_retries,
+        description="spelling correction and email generation"
+    )
+    content = response.choices[0].message.content
+    try:
+        corrected_text, email_content = parse_fused_response(content)
+    except ValueError as e:
+        # json.JSONDecodeError is a ValueError too
+        logger.warning(f"Fused response failed validation ({str(e)}); falling back to two calls")
+        corrected_text = correct_spelling(client, transcription, max_retries, priority, cache)
+        email_content = generate_email(client, corrected_text, BATCH_DOCTOR_NAME, BATCH_PATIENT_NAME, max_retries, priority=priority, cache=cache)
+        return corrected_text, email_content
 
-# def handle_patient_interaction(client, user_input, conversation_history, max_retries=3):
-    system_prompt = """
-    You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
+    if cache is not None:
+        cache.put(cache_key, content)
+    return corrected_text, email_content
 
-    Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
+def format_doctor_shortlist(doctor_shortlist):
+    doctors = "\n".join(
+        f"- {doctor['name']} ({doctor.get('specialty', 'General practice')})"
+        for _, doctor in doctor_shortlist
+    )
+    return (
+        f"Doctors from the directory whose profiles are most similar to the patient's question, most similar first:\n{doctors}\n"
+        "The ranking is by text similarity only. Offer them when helping the patient choose a doctor, but only those whose specialty fits the question."
+    )
 
-    You will not handle medication refills. You will not handle scheduling. You will not handle bill payment. 
+def interaction_messages(user_input, conversation_history, doctor_shortlist=None):
+    system_messages = [{"role": "system", "content": PATIENT_SYSTEM_PROMPT}]
+    if doctor_shortlist:
+        system_messages.append({"role": "system", "content": format_doctor_shortlist(doctor_shortlist)})
+    return [
+        *system_messages,
+        *conversation_history,
+        {"role": "user", "content": user_input}
+    ]
 
-    If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
+def parse_patient_question(response):
+    """The {"patient_question", "doctor_name", ...} object in a reply, or None."""
+    try:
+        question_json = json.loads(response)
+    except json.JSONDecodeError:
+        return None  # Not a JSON response, continue the conversation
+    if isinstance(question_json, dict) and 'patient_question' in question_json and 'doctor_name' in question_json:
+        return question_json
+    return None
+
+def handle_patient_interaction(client, user_input, conversation_history, max_retries=None, stream=False, on_token=None, json_detector=None, doctor_shortlist=None):
+    """Ask GPT-4 for the assistant's next turn.
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, respond with a JSON object containing the patient's question and the doctor's name. The JSON should be in the format: {"patient_question": "The patient's question here", "doctor_name": "Dr. Name"}. Do not say anything else after outputting the JSON.
+    With stream=True each token is passed to on_token as it arrives, and
+    json_detector (an IncrementalJsonDetector) is fed along the way so the
+    final patient_question JSON is recognised without re-parsing the reply.
+    doctor_shortlist, as returned by DoctorMatcher.shortlist, is given to the
+    model so it can offer matching doctors straight away.
     """
+    messages = interaction_messages(user_input, conversation_history, doctor_shortlist)
+    started = time.perf_counter()
+    response = get_scheduler().call(
+        lambda: client.chat.completions.create(model="gpt-4", messages=messages, stream=stream),
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_chat_tokens(messages),
+        max_retries=max_retries,
+        description="patient interaction"
+    )
+    if stream:
+        stream_stats = {}
+        reply = consume_stream(response, on_token, json_detector, stream_stats).strip()
+        record_stream("patient interaction", started, stream_stats, messages)
+        return reply
+    return response.choices[0].message.content.strip()
 
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    *conversation_history,
-                    {"role": "user", "content": user_input}
-                ]
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
+def create_async_client(api_key, max_connections=API_MAX_CONNECTIONS, base_url=None):
+    """One AsyncOpenAI client whose keep-alive connection pool is shared by every request."""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60),
+        timeout=httpx.Timeout(120.0, connect=10.0)
+    )
+    # Retries are handled by the shared scheduler, not per client
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
 
-def generate_email(client, patient_question, doctor_name, patient_name, max_retries=3):
-    prompt = f"""
-    Please draft an email to {doctor_name} regarding the following question:
-    
-    Dear {doctor_name},
+async def request_transcription_async(client, file_path, max_retries=None, priority=INTERACTIVE):
+    def read_audio():
+        with open(file_path, "rb") as audio_file:
+            return audio_file.read()
 
-    {patient_question}
+    audio = await asyncio.to_thread(read_audio)
+    transcription = await get_scheduler().call_async(
+        lambda: client.audio.transcriptions.create(
+            model=TRANSCRIPTION_MODEL,
+            file=(os.path.basename(file_path), audio),
+            response_format=TRANSCRIPTION_FORMAT
+        ),
+        priority=priority,
+        max_retries=max_retries,
+        description="transcription"
+    )
+    return transcription if isinstance(transcription, str) else transcription.text
 
-    Sincerely,
-    {patient_name}
+async def transcribe_async(client, file_path, max_retries=None, cache=None, priority=INTERACTIVE, preprocess=False):
+    """Awaitable transcribe_with_retry for the HTTP API; file work runs in threads."""
+    cache_key = None
+    if cache is not None:
+        variant = PREPROCESSED_VARIANT if preprocess else ""
+        cache_key = await asyncio.to_thread(audio_cache_key, file_path, TRANSCRIPTION_MODEL, TRANSCRIPTION_FORMAT, variant)
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            logger.info(f"Transcription cache hit for {file_path}")
+            return cached
+
+    with tempfile.TemporaryDirectory(prefix="docotoc-audio-") as work_dir:
+        upload_path = file_path
+        audio_seconds = None
+        if preprocess:
+            upload_path, stats = await asyncio.to_thread(preprocess_audio, file_path, work_dir)
+            audio_seconds = stats["processed_seconds"]
+        transcription = await request_transcription_async(client, upload_path, max_retries, priority)
+        await asyncio.to_thread(record_audio_seconds, upload_path, audio_seconds)
+
+    if cache is not None:
+        await asyncio.to_thread(cache.put, cache_key, transcription)
+    return transcription
+
+async def correct_spelling_async(client, transcription, max_retries=None, priority=INTERACTIVE, cache=None):
+    cache_key = None
+    if cache is not None:
+        cache_key = spelling_cache_key(transcription)
+        # The response cache may be backed by SQLite, so it is used from worker threads
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    messages = spelling_messages(transcription)
+    response = await get_scheduler().call_async(
+        lambda: client.chat.completions.create(model="gpt-4", messages=messages),
+        priority=priority,
+        estimated_tokens=estimate_chat_tokens(messages, max_tokens=len(transcription) // 3),
+        max_retries=max_retries,
+        description="spelling correction"
+    )
+    corrected_text = response.choices[0].message.content
+    if cache is not None:
+        await asyncio.to_thread(cache.put, cache_key, corrected_text)
+    return corrected_text
+
+async def generate_email_async(client, patient_question, doctor_name, patient_name, max_retries=None, priority=INTERACTIVE, cache=None):
+    cache_key = None
+    if cache is not None:
+        cache_key = email_cache_key(patient_question, doctor_name, patient_name)
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    messages = email_messages(patient_question, doctor_name, patient_name)
+    response = await get_scheduler().call_async(
+        lambda: client.chat.completions.create(model="gpt-4", messages=messages, max_tokens=EMAIL_MAX_TOKENS),
+        priority=priority,
+        estimated_tokens=estimate_chat_tokens(messages, max_tokens=EMAIL_MAX_TOKENS),
+        max_retries=max_retries,
+        description="email generation"
+    )
+    email_content = response.choices[0].message.content.strip()
+    if cache is not None:
+        await asyncio.to_thread(cache.put, cache_key, email_content)
+    return email_content
+
+async def handle_patient_interaction_async(client, user_input, conversation_history, max_retries=None, doctor_shortlist=None):
+    messages = interaction_messages(user_input, conversation_history, doctor_shortlist)
+    response = await get_scheduler().call_async(
+        lambda: client.chat.completions.create(model="gpt-4", messages=messages),
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_chat_tokens(messages),
+        max_retries=max_retries,
+        description="patient interaction"
+    )
+    return response.choices[0].message.content.strip()
+
+def process_batch(client, audio_paths, transcribe_workers=4, correct_workers=4, email_workers=4, cache=None, chunked=False, preprocess=False, response_cache=None, fused=False, manifest=None):
+    """Run transcribe -> correct -> email over audio_paths as a pipeline.
+
+    Every stage has its own bounded thread pool and a file moves on to the next
+    stage as soon as its previous one finishes, so file N+1 can be transcribed
+    while file N is being corrected. Returns one result dict per file, in the
+    order of audio_paths; a failed file has its "error" set and keeps the
+    outputs of the stages that did complete. With fused=True correction and
+    email drafting are one GPT-4 call (see correct_and_draft_email) run on the
+    correct_workers pool.
+
+    With a BatchManifest, every finished or failed stage is appended to it and
+    stages whose outputs it already holds are skipped; "resumed" lists them.
     """
+    results = [
+        {"file": path, "transcription": None, "corrected_text": None, "email": None, "error": None, "elapsed": None, "preprocessing": None, "resumed": []}
+        for path in audio_paths
+    ]
+    if not results:
+        return results
+    if manifest is not None:
+        for result in results:
+            result.update(manifest.completed_outputs(result["file"]))
+
+    def transcribe(result):
+        preprocessing = {}
+        transcription = transcribe_with_retry(
+            client, result["file"], cache=cache, chunked=chunked, preprocess=preprocess,
+            on_preprocessed=preprocessing.update
+        )
+        return {"transcription": transcription, "preprocessing": preprocessing or None}
+
+    transcribe_pool = ThreadPoolExecutor(max_workers=transcribe_workers, thread_name_prefix="transcribe")
+    correct_pool = ThreadPoolExecutor(max_workers=correct_workers, thread_name_prefix="correct")
+    email_pool = ThreadPoolExecutor(max_workers=email_workers, thread_name_prefix="email")
+    # Each stage returns the result fields it fills in; it is done once its
+    # required fields are set
+    stages = [
+        ("transcription", ("transcription",), transcribe_pool, transcribe),
+    ]
+    if fused:
+        stages.append(("correction and email", ("corrected_text", "email"), correct_pool, lambda result: dict(zip(
+            ("corrected_text", "email"),
+            correct_and_draft_email(client, result["transcription"], cache=response_cache)
+        ))))
+    else:
+        stages.append(("corrected_text", ("corrected_text",), correct_pool, lambda result: {
+            "corrected_text": correct_spelling(client, result["transcription"], cache=response_cache)
+        }))
+        stages.append(("email", ("email",), email_pool, lambda result: {
+            "email": generate_email(client, result["corrected_text"], BATCH_DOCTOR_NAME, BATCH_PATIENT_NAME, priority=BATCH, cache=response_cache)
+        }))
+
+    metrics = get_metrics()
+
+    def run_stage(stage, run, result):
+        with metrics.span(f"batch {stage}", stage=stage):
+            return run(result)
+
+    remaining = [len(results)]
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def finish(result, started):
+        result["elapsed"] = time.perf_counter() - started
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                all_done.set()
+
+    def advance(result, stage_index, started):
+        if stage_index == len(stages):
+            logger.info(f"Finished {result['file']} in {time.perf_counter() - started:.1f}s")
+            finish(result, started)
+            return
+        stage, fields, pool, run = stages[stage_index]
+        if all(result[field] is not None for field in fields):
+            result["resumed"].append(stage)
+            advance(result, stage_index + 1, started)
+            return
+
+        def on_done(future):
+            # Runs as a done-callback, where an exception would be logged and
+            # dropped without finishing the file; a failed manifest write
+            # fails the file instead of hanging the batch
+            try:
+                updates = future.result()
+                result.update(updates)
+                if manifest is not None:
+                    manifest.record_done(result["file"], stage, updates)
+            except Exception as e:
+                logger.error(f"{stage} failed for {result['file']}: {str(e)}")
+                result["error"] = f"{stage}: {str(e)}"
+                if manifest is not None:
+                    try:
+                        manifest.record_failed(result["file"], stage, str(e))
+                    except Exception as manifest_error:
+                        logger.error(f"Could not record the failure in {manifest.path}: {str(manifest_error)}")
+                finish(result, started)
+                return
+            advance(result, stage_index + 1, started)
 
-    for attempt in range(max_retries):
+        pool.submit(run_stage, stage, run, result).add_done_callback(on_done)
+
+    try:
+        for result in results:
+            advance(result, 0, time.perf_counter())
+        all_done.wait()
+    finally:
+        for pool in (transcribe_pool, correct_pool, email_pool):
+            pool.shutdown(wait=True)
+
+    return results
+
+def print_batch_report(results, elapsed):
+    for result in results:
+        print(f"\nFile: {result['file']}")
+        if result["error"]:
+            print(f"Failed after {result['elapsed']:.1f}s: {result['error']}")
+        else:
+            print("Original Transcription:")
+            print(result["transcription"])
+            print("\nCorrected Transcription:")
+            print(result["corrected_text"])
+            print("\nGenerated Email:")
+            print(result["email"])
+            if result["preprocessing"]:
+                stats = result["preprocessing"]
+                print(f"\nPreprocessing saved {stats['saved_bytes'] / 1024:.0f} KB and {stats['saved_seconds']:.1f}s of audio")
+            if result["resumed"]:
+                print(f"\nReused from the manifest: {', '.join(result['resumed'])}")
+            print(f"\nProcessed in {result['elapsed']:.1f}s")
+        print("-" * 50)
+
+    failed = sum(1 for result in results if result["error"])
+    throughput = len(results) / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"Processed {len(results)} files ({failed} failed) in {elapsed:.1f}s - {throughput:.1f} files/min")
+    preprocessed = [result["preprocessing"] for result in results if result["preprocessing"]]
+    if preprocessed:
+        saved_bytes = sum(stats["saved_bytes"] for stats in preprocessed)
+        saved_seconds = sum(stats["saved_seconds"] for stats in preprocessed)
+        print(f"Preprocessing saved {saved_bytes / (1024 * 1024):.1f} MB of uploads and {saved_seconds / 60:.1f} billed minutes")
+    resumed = sum(len(result["resumed"]) for result in results)
+    if resumed:
+        print(f"Skipped {resumed} stages already finished in the manifest")
+
+def run_batch(client, args):
+    if args.files:
+        audio_paths = expand_audio_paths(args.files)
+    else:
+        audio_paths = [os.path.join(AUDIO_DIR, audio_file) for audio_file in AUDIO_FILES]
+    logger.info(f"Processing {len(audio_paths)} files")
+    manifest = BatchManifest(args.manifest) if args.manifest else None
+
+    response_cache = None if args.no_cache else get_response_cache()
+    started = time.perf_counter()
+    results = process_batch(
+        client,
+        audio_paths,
+        transcribe_workers=args.transcribe_workers,
+        correct_workers=args.correct_workers,
+        email_workers=args.email_workers,
+        cache=None if args.no_cache else get_transcription_cache(),
+        chunked=args.chunk,
+        preprocess=args.preprocess,
+        response_cache=response_cache,
+        fused=args.fused,
+        manifest=manifest
+    )
+    print_batch_report(results, time.perf_counter() - started)
+    if response_cache is not None:
+        stats = response_cache.stats()
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
+
+def find_previous_answer(answer_index, user_input):
+    if answer_index is None or len(user_input.split()) < ANSWER_MIN_WORDS:
+        return None
+    match = answer_index.find_answer(user_input, ANSWER_MATCH_THRESHOLD)
+    if match is None:
+        return None
+    score, entry = match
+    logger.info(f"Answered from previous communication {entry['id']} (similarity {score:.2f})")
+    # The stored answer was given to an earlier question, so it is offered as
+    # the answer to that question, not as advice that applies to this patient
+    return (
+        f"Is this your question? \"{entry['question']}\"\n"
+        f"Your doctor answered it before: {entry['answer']}\n"
+        "If your question is different, or that answer may not apply to you, I can help you send your own question to your doctor."
+    )
+
+def run_interactive(client, stream=True):
+    # Handle patient interaction
+    print("Welcome to DocoToc. How may I help you today?")
+    context = ConversationContext(max_tokens=CONTEXT_TOKEN_BUDGET)
+    answer_index = AnswerIndex(ANSWER_INDEX_DIR) if os.path.exists(ANSWER_INDEX_DIR) else None
+    doctor_matcher = DoctorMatcher.from_directory(DOCTOR_DIRECTORY_PATH) if os.path.exists(DOCTOR_DIRECTORY_PATH) else None
+    doctor_shortlist = None
+    intent_classifier = IntentClassifier()
+    response_cache = get_response_cache()
+    patient_name = input("Please enter your name: ")  # Ask for the patient's name
+
+    while True:
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that writes concise emails."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=150  # Approximately 450 characters
-            )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
+            user_input = input("Patient: ")
+            if user_input.lower() == 'exit':
+                break
+
+            # Refill, scheduling and billing requests and questions answered
+            # before are handled locally, without a GPT-4 call
+            local_reply = intent_classifier.fast_reply(user_input) or find_previous_answer(answer_index, user_input)
+            if local_reply is not None:
+                print("DocoToc:", local_reply)
+                context.add("user", user_input)
+                context.add("assistant", local_reply)
+                continue
+
+            # Rank doctors on the latest substantive question, not on "yes" or "thanks"
+            if doctor_matcher is not None and len(user_input.split()) >= ANSWER_MIN_WORDS:
+                doctor_shortlist = doctor_matcher.shortlist(user_input, k=DOCTOR_SHORTLIST_SIZE, min_score=DOCTOR_MATCH_THRESHOLD)
+
+            # The history sent with the request excludes this turn, which goes in as user_input
+            conversation_history = context.messages()
+            if stream:
+                # Tokens are printed as they arrive and the JSON check runs on the stream
+                json_detector = IncrementalJsonDetector()
+                print("DocoToc: ", end="", flush=True)
+                response = handle_patient_interaction(client, user_input, conversation_history, stream=True, on_token=print_token, json_detector=json_detector, doctor_shortlist=doctor_shortlist)
+                print()
+                question_json = json_detector.result
             else:
-                logger.error("Max retries reached. Unable to generate email.")
-                raise e
+                response = handle_patient_interaction(client, user_input, conversation_history, doctor_shortlist=doctor_shortlist)
+                print("DocoToc:", response)
+                # Check if the response is a JSON object containing a patient question
+                question_json = parse_patient_question(response)
+            context.add("user", user_input)
+            context.add("assistant", response)
 
+            if isinstance(question_json, dict) and 'patient_question' in question_json and 'doctor_name' in question_json:
+                print(f"Patient question for {question_json['doctor_name']} detected. Generating email...")
+                print(f"\nGenerated Email for {question_json['doctor_name']}:")
+                if stream:
+                    generate_email(client, question_json['patient_question'], question_json['doctor_name'], patient_name, stream=True, on_token=print_token, cache=response_cache)
+                    print()
+                else:
+                    print(generate_email(client, question_json['patient_question'], question_json['doctor_name'], patient_name, cache=response_cache))
+                break
+        except EOFError:
+            print("No input received. Exiting.")
+            break
 
-def handle_patient_interaction(client, user_input, conversation_history, max_retries=3):
-    system_prompt = """
-    You are a helpful assistant talking to a patient. You will start with "Welcome to DocoToc. How may I help you today?". Then wait for the answers. The person you are talking to is a patient. Please ask clarifying questions as necessary.  
+    if intent_classifier.calls_saved:
+        logger.info(f"Intent classifier saved {intent_classifier.calls_saved} GPT-4 calls this session")
 
-    Right now, you can only handle a single task to help your patient to ask a question to their doctor. And you can help the patient to choose the right doctor, and then draft an email for them. 
+def write_upload(file_path, data):
+    with open(file_path, "wb") as upload_file:
+        upload_file.write(data)
 
-    You will not handle medication refills. You will not handle scheduling. You will not handle bill payment. 
+class PatientApi:
+    """asyncio HTTP API serving many patient sessions from one process.
 
-    If the user asks something that is out of your knowledge or capabilities, politely inform them that you are a POC prototype and unable to assist with their request yet. Please also tell your patient what you can do so far. And ask for anything else you can be of help. If there is an exception or error, handle it gracefully and provide a useful response.
+    Routes:
+      GET  /, /health                       liveness and scheduler stats
+      POST /sessions                        {"patient_name"} -> {"session_id"}
+      POST /sessions/{id}/interaction       {"message"} -> {"reply", "question", "email"}
+      DELETE /sessions/{id}
+      POST /transcription                   audio body (?filename=&correct=&preprocess=) -> {"transcription"[, "corrected_text"]}
+      POST /email                           {"patient_question", "doctor_name", "patient_name"} -> {"email"}
 
-    If you find out the patient's ask is about asking a question to their doctor, then, confirm "so you want me to help you asking this question to your doctor?". As soon as you get a positive confirmation, respond with a JSON object containing the patient's question and the doctor's name. The JSON should be in the format: {"patient_question": "The patient's question here", "doctor_name": "Dr. Name", "patient_name": "Patient Name"}. Do not say anything else after outputting the JSON.
+    A session follows run_interactive: local replies first, then GPT-4, and
+    an email once the reply carries the patient question. Sessions are kept in
+    a SessionStore; turns of one session are serialised, different sessions
+    run concurrently.
     """
 
-    for attempt in range(max_retries):
+    def __init__(self, client, sessions=None):
+        self.client = client
+        self.sessions = sessions or get_session_store()
+        # Only sessions with a turn in flight hold a lock
+        self.turn_locks = weakref.WeakValueDictionary()
+        self.answer_index = AnswerIndex(ANSWER_INDEX_DIR) if os.path.exists(ANSWER_INDEX_DIR) else None
+        self.doctor_matcher = DoctorMatcher.from_directory(DOCTOR_DIRECTORY_PATH) if os.path.exists(DOCTOR_DIRECTORY_PATH) else None
+        self.intent_classifier = IntentClassifier()
+        self.response_cache = get_response_cache()
+        self.transcription_cache = get_transcription_cache()
+
+    def build_app(self):
+        app = web.Application(client_max_size=API_MAX_UPLOAD_BYTES, middlewares=[self.request_middleware])
+        app.add_routes([
+            web.get("/", self.health),
+            web.get("/health", self.health),
+            web.get("/metrics", self.metrics),
+            web.post("/sessions", self.create_session),
+            web.post("/sessions/{session_id}/interaction", self.interaction),
+            web.delete("/sessions/{session_id}", self.delete_session),
+            web.post("/transcription", self.transcription),
+            web.post("/email", self.email),
+        ])
+        app.on_cleanup.append(self.close)
+        return app
+
+    async def close(self, app):
+        await self.client.close()
+
+    @web.middleware
+    async def request_middleware(self, request, handler):
+        """Times every request by route and turns failures into JSON errors."""
+        resource = request.match_info.route.resource
+        route = f"{request.method} {resource.canonical if resource is not None else 'unmatched'}"
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    *conversation_history,
-                    {"role": "user", "content": user_input}
-                ]
+            with get_metrics().span(route, stage=route):
+                return await handler(request)
+        except web.HTTPException:
+            raise
+        except OpenAIError as e:
+            logger.error(f"OpenAI request failed for {request.path}: {str(e)}")
+            return web.json_response({"error": str(e)}, status=502)
+        except Exception as e:
+            logger.exception(f"Unhandled error for {request.path}")
+            return web.json_response({"error": str(e)}, status=500)
+
+    async def read_json(self, request, *fields):
+        try:
+            payload = await request.json()
+        except ValueError:
+            # JSONDecodeError, or UnicodeDecodeError for a body that is not UTF-8
+            raise web.HTTPBadRequest(text="Request body must be JSON")
+        if not isinstance(payload, dict):
+            raise web.HTTPBadRequest(text="Request body must be a JSON object")
+        missing = [field for field in fields if not isinstance(payload.get(field), str) or not payload[field].strip()]
+        if missing:
+            raise web.HTTPBadRequest(text=f"Missing fields: {', '.join(missing)}")
+        return payload
+
+    async def health(self, request):
+        return web.json_response({
+            "status": "ok",
+            "sessions": self.sessions.stats(),
+            "scheduler": get_scheduler().stats
+        })
+
+    async def metrics(self, request):
+        return web.Response(body=get_metrics().render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def create_session(self, request):
+        payload = await self.read_json(request, "patient_name")
+        # The store may write to SQLite, so it is only used from worker threads
+        session = await asyncio.to_thread(self.sessions.create, payload["patient_name"])
+        return web.json_response({"session_id": session.session_id, "reply": "Welcome to DocoToc. How may I help you today?"})
+
+    async def delete_session(self, request):
+        if not await asyncio.to_thread(self.sessions.delete, request.match_info["session_id"]):
+            raise web.HTTPNotFound(text="Unknown session")
+        return web.json_response({"deleted": True})
+
+    async def interaction(self, request):
+        session_id = request.match_info["session_id"]
+        user_input = (await self.read_json(request, "message"))["message"]
+        async with self.turn_locks.setdefault(session_id, asyncio.Lock()):
+            session = await asyncio.to_thread(self.sessions.get, session_id)
+            if session is None:
+                raise web.HTTPNotFound(text="Unknown session")
+            reply = await self.take_turn(session, user_input)
+            await asyncio.to_thread(self.sessions.save, session)
+        return web.json_response(reply)
+
+    async def take_turn(self, session, user_input):
+        context = session.context
+        metrics = get_metrics()
+        with metrics.span("local reply", stage="local_reply"):
+            local_reply = self.intent_classifier.fast_reply(user_input) or find_previous_answer(self.answer_index, user_input)
+        if local_reply is not None:
+            context.add("user", user_input)
+            context.add("assistant", local_reply)
+            return {"reply": local_reply, "question": None, "email": None}
+
+        if self.doctor_matcher is not None and len(user_input.split()) >= ANSWER_MIN_WORDS:
+            with metrics.span("doctor matching", stage="doctor_matching"):
+                session.doctor_shortlist = self.doctor_matcher.shortlist(user_input, k=DOCTOR_SHORTLIST_SIZE, min_score=DOCTOR_MATCH_THRESHOLD)
+
+        response = await handle_patient_interaction_async(self.client, user_input, context.messages(), doctor_shortlist=session.doctor_shortlist)
+        context.add("user", user_input)
+        context.add("assistant", response)
+
+        question_json = parse_patient_question(response)
+        email_content = None
+        if question_json is not None:
+            email_content = await generate_email_async(
+                self.client, question_json['patient_question'], question_json['doctor_name'], session.patient_name, cache=self.response_cache
             )
-            return response.choices[0].message.content.strip()
-        except RateLimitError as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)  # Exponential backoff
-            else:
-                logger.error("Max retries reached. Unable to handle patient interaction.")
-                raise e
-
-# def main():
-#     try:
-#         api_key = get_api_key()
-#         logger.info(f"API Key: {api_key[:5]}...{api_key[-5:]}")  # Log first and last 5 characters
-        
-#         client = OpenAI(api_key=api_key)
-        
-#         audio_files = [
-#             "0_Blood Sugar Monitoring Guidelines.mp3",
-#             "1_Calcium Supplements_ Stay or Go_.mp3",
-#             "2_Managing Daily Tasks with Alzheimer's.mp3",
-#             "3_Can I Stop My Hypertension Meds_.mp3",
-#             "4_Asthma Meds in Pregnancy_ Safety Guide.mp3",
-#             "5_Metformin and Constipation Concerns.mp3",
-#             "6_New Options for Depression Treatment.mp3",
-#             "7_Breast Cancer Gene Inheritance Risks.mp3",
-#             "8_Monitoring Your Heart Health.mp3",
-#             "9_Managing Arthritis and Exercise Pain.mp3"
-#         ]
-        
-#         for audio_file in audio_files:
-#             # print("Current working directory:", os.getcwd())
-#             # print("Contents of audio_files directory:", os.listdir("audio_files"))
-#             logger.info(f"Processing file: {audio_file}")
-            
-#             # Transcribe audio
-#             audio_file_path = os.path.join("audio_files", audio_file)
-#             transcription = transcribe_with_retry(client, audio_file_path)
-#             logger.info("Transcription completed")
-            
-#             # Correct spelling
-#             corrected_text = correct_spelling(client, transcription)
-#             logger.info("Spelling correction completed")
-            
-#             # Generate email
-#             email_content = generate_email(client, corrected_text)
-#             logger.info("Email generation completed")
-            
-#             # Print results
-#             print(f"\nFile: {audio_file}")
-#             print("Original Transcription:")
-#             print(transcription)
-#             print("\nCorrected Transcription:")
-#             print(corrected_text)
-#             print("\nGenerated Email:")
-#             print(email_content)
-#             print("-" * 50)
-        
-#     except Exception as e:
-#         logger.error(f"An error occurred: {str(e)}")
+        return {"reply": response, "question": question_json, "email": email_content}
+
+    async def transcription(self, request):
+        audio = await request.read()
+        if not audio:
+            raise web.HTTPBadRequest(text="Request body must be the audio file")
+        filename = os.path.basename(request.query.get("filename", "audio.mp3"))
+        correct = request.query.get("correct", "false").lower() in ("1", "true", "yes")
+        preprocess = request.query.get("preprocess", "false").lower() in ("1", "true", "yes")
+
+        with tempfile.TemporaryDirectory(prefix="docotoc-upload-") as work_dir:
+            file_path = os.path.join(work_dir, filename)
+            await asyncio.to_thread(write_upload, file_path, audio)
+            transcription = await transcribe_async(self.client, file_path, cache=self.transcription_cache, preprocess=preprocess)
+
+        result = {"transcription": transcription}
+        if correct:
+            result["corrected_text"] = await correct_spelling_async(self.client, transcription, cache=self.response_cache)
+        return web.json_response(result)
+
+    async def email(self, request):
+        payload = await self.read_json(request, "patient_question", "doctor_name", "patient_name")
+        email_content = await generate_email_async(
+            self.client, payload["patient_question"], payload["doctor_name"], payload["patient_name"], cache=self.response_cache
+        )
+        return web.json_response({"email": email_content})
+
+def run_server(api_key, host="0.0.0.0", port=API_PORT):
+    api = PatientApi(create_async_client(api_key))
+    logger.info(f"DocoToc API listening on http://{host}:{port}")
+    web.run_app(api.build_app(), host=host, port=port, print=None)
+
+def run_cache_command(args):
+    cache = get_transcription_cache()
+    if args.action == "clear":
+        removed = cache.clear()
+        get_response_cache().clear()
+        print("Cleared the response cache")
+    else:
+        removed = sum(
+            cache.invalidate(audio_cache_key(file_path, TRANSCRIPTION_MODEL, TRANSCRIPTION_FORMAT, variant))
+            for file_path in args.files
+            for variant in ("", PREPROCESSED_VARIANT)
+        )
+    print(f"Removed {removed} cached transcriptions from {cache.directory}")
+
+def run_index_command(args):
+    answer_index = AnswerIndex(ANSWER_INDEX_DIR)
+    if args.action == "update":
+        records = []
+        with open(args.source, "r", encoding="utf-8") as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record.setdefault("id", hashlib.sha1(record["question"].encode("utf-8")).hexdigest())
+                records.append(record)
+        answer_index.upsert_many(records)
+        print(f"Indexed {len(records)} communications; {len(answer_index)} in {ANSWER_INDEX_DIR}")
+    else:
+        for score, entry in answer_index.search(args.source, k=args.top_k):
+            print(f"{score:.3f}  {entry['question']}\n       {entry['answer']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DocoToc patient assistant")
+    parser.add_argument("--no-stream", action="store_true", help="Print each reply only once it is complete")
+    parser.add_argument("--metrics-file", help="Write Prometheus-format timings, token counts and retries here on exit")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch_parser = subparsers.add_parser("batch", help="Transcribe, correct and draft emails for a set of recordings")
+    batch_parser.add_argument("files", nargs="*", help="Audio files, directories or glob patterns to process (defaults to the audio_files corpus)")
+    batch_parser.add_argument("--transcribe-workers", type=int, default=4, help="Concurrent transcriptions")
+    batch_parser.add_argument("--correct-workers", type=int, default=4, help="Concurrent spelling corrections")
+    batch_parser.add_argument("--email-workers", type=int, default=4, help="Concurrent email drafts")
+    batch_parser.add_argument("--no-cache", action="store_true", help="Always call the API, bypassing the transcription and response caches")
+    batch_parser.add_argument("--chunk", action="store_true", help="Split long recordings on silences and transcribe the pieces in parallel")
+    batch_parser.add_argument("--fused", action="store_true", help="Correct the transcript and draft the email in a single GPT-4 call")
+    batch_parser.add_argument("--manifest", help="JSONL file recording each stage's output; a re-run skips the stages it already holds")
+    batch_parser.add_argument("--preprocess", action="store_true", help="Trim silence and upload compact 16 kHz mono Opus instead of the original audio")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve patient sessions, transcription and email drafting over HTTP")
+    serve_parser.add_argument("--host", default="0.0.0.0", help="Interface to listen on")
+    serve_parser.add_argument("--port", type=int, default=API_PORT, help="Port to listen on")
+
+    cache_parser = subparsers.add_parser("cache", help="Manage the transcription and response caches")
+    cache_parser.add_argument("action", choices=["clear", "invalidate"], help="Drop every entry, or only the transcriptions of the given files")
+    cache_parser.add_argument("files", nargs="*", help="Audio files to invalidate")
+
+    index_parser = subparsers.add_parser("index", help="Manage the index of previous doctor-patient communications")
+    index_parser.add_argument("action", choices=["update", "query"], help="Upsert communications from a JSONL file, or search the index")
+    index_parser.add_argument("source", help="JSONL file of {\"question\", \"answer\"[, \"id\"]} records, or the question to search for")
+    index_parser.add_argument("--top-k", type=int, default=3, help="Number of matches to show for a query")
+
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    if args.command == "cache":
+        run_cache_command(args)
+        return
+    if args.command == "index":
+        run_index_command(args)
+        return
+
     try:
         api_key = get_api_key()
-        logger.info(f"API Key: {api_key[:5]}...{api_key[-5:]}")  # Log first and last 5 characters
-        
-        client = OpenAI(api_key=api_key)
-        
-        # Handle patient interaction
-        print("Welcome to DocoToc. How may I help you today?")
-        conversation_history = []
-        patient_name = input("Please enter your name: ")  # Ask for the patient's name
-
-        while True:
-            try:
-                user_input = input("Patient: ")
-                if user_input.lower() == 'exit':
-                    break
-                
-                conversation_history.append({"role": "user", "content": user_input})
-                response = handle_patient_interaction(client, user_input, conversation_history)
-                print("DocoToc:", response)
-                conversation_history.append({"role": "assistant", "content": response})
-                
-                # Check if the response is a JSON object containing a patient question
-                try:
-                    question_json = json.loads(response)
-                    if 'patient_question' in question_json and 'doctor_name' in question_json:
-                        print(f"Patient question for {question_json['doctor_name']} detected. Generating email...")
-                        email_content = generate_email(client, question_json['patient_question'], question_json['doctor_name'], patient_name)
-                        print(f"\nGenerated Email for {question_json['doctor_name']}:")
-                        print(email_content)
-                        break
-                except json.JSONDecodeError:
-                    pass  # Not a JSON response, continue the conversation
-            except EOFError:
-                print("No input received. Exiting.")
-                break
-        
-        # audio_files = [
-        #     "0_Blood Sugar Monitoring Guidelines.mp3",
-        #     "1_Calcium Supplements_ Stay or Go_.mp3",
-        #     "2_Managing Daily Tasks with Alzheimer's.mp3",
-        #     "3_Can I Stop My Hypertension Meds_.mp3",
-        #     "4_Asthma Meds in Pregnancy_ Safety Guide.mp3",
-        #     "5_Metformin and Constipation Concerns.mp3",
-        #     "6_New Options for Depression Treatment.mp3",
-        #     "7_Breast Cancer Gene Inheritance Risks.mp3",
-        #     "8_Monitoring Your Heart Health.mp3",
-        #     "9_Managing Arthritis and Exercise Pain.mp3"
-        # ]
-        
-        # for audio_file in audio_files:
-            # logger.info(f"Processing file: {audio_file}")
-            
-            # Transcribe audio
-            # audio_file_path = os.path.join("audio_files", audio_file)
-            # transcription = transcribe_with_retry(client, audio_file_path)
-            # logger.info("Transcription completed")
-            
-            # Correct spelling
-            # corrected_text = correct_spelling(client, transcription)
-            # logger.info("Spelling correction completed")
-            
-            # Generate email
-            # email_content = generate_email(client, corrected_text)
-            # logger.info("Email generation completed")
-            
-            # Print results
-            # print(f"\nFile: {audio_file}")
-            # print("Original Transcription:")
-            # print(transcription)
-            # print("\nCorrected Transcription:")
-            # print(corrected_text)
-            # print("\nGenerated Email:")
-            # print(email_content)
-            # print("-" * 50)
-        
+
+        if args.command == "serve":
+            run_server(api_key, host=args.host, port=args.port)
+            return
+
+        # Retries are handled by the shared scheduler, not per client
+        client = OpenAI(api_key=api_key, max_retries=0)
+
+        if args.command == "batch":
+            run_batch(client, args)
+        else:
+            run_interactive(client, stream=not args.no_stream)
+
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
+    finally:
+        if args.metrics_file:
+            with open(args.metrics_file, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(get_metrics().render())
 
 if __name__ == "__main__":
     main()
-
-# if __name__ == "__main__":
-#     main()
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import get_metrics
+
+DEFAULT_DB_PATH = os.path.join(".cache", "responses.sqlite3")
+
+
+def normalize_text(text):
+    """Case, whitespace and punctuation are folded so near-identical inputs share a key."""
+    text = re.sub(r"[^\w\s']", " ", text.lower())
+    return " ".join(text.split())
+
+
+def prompt_version(*prompts):
+    """Short hash of the prompt text, so editing a prompt invalidates its entries."""
+    return hashlib.sha256("\0".join(prompts).encode("utf-8")).hexdigest()[:12]
+
+
+def response_cache_key(kind, model, version, *inputs):
+    normalized = "\0".join(normalize_text(text) for text in inputs)
+    return hashlib.sha256(f"{kind}\0{model}\0{version}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of model responses with a TTL, optionally backed by SQLite.
+
+    The in-process LRU holds up to max_entries responses. With db_path set,
+    entries are also written to SQLite so they survive restarts and are shared
+    by worker processes; misses in memory fall through to the database, and
+    the database is pruned to max_disk_entries. hits/misses count lookups.
+    """
+
+    # Expired and surplus rows are pruned on every this many writes
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, max_entries=1024, ttl=7 * 24 * 3600, db_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self._db.commit()
+
+    def get(self, key):
+        value = self._lookup(key)
+        get_metrics().increment("docotoc_cache_lookups_total", cache="response", result="miss" if value is None else "hit")
+        return value
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def _remember(self, key, value, created):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        created = time.time()
+        with self._lock:
+            self._remember(key, value, created)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)", (key, value, created))
+                self._writes += 1
+                if self._writes % self.PRUNE_INTERVAL == 0:
+                    self._db.execute("DELETE FROM responses WHERE created < ?", (created - self.ttl,))
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                        (self.max_disk_entries,)
+                    )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries)
+            }
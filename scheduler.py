@@ -0,0 +1,270 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+import email.utils
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower values are served first
+INTERACTIVE = 0
+BATCH = 1
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# How often waiters that are not at the head of the queue re-check it from asyncio
+ASYNC_POLL_INTERVAL = 0.05
+
+
+def estimate_chat_tokens(messages, max_tokens=None):
+    """Rough token estimate of a chat request for the tokens-per-minute budget.
+
+    Uses ~4 characters per token for the prompt plus the completion allowance;
+    the estimate is corrected from the response's usage once it comes back.
+    """
+    prompt_tokens = sum((len(message["content"]) + 3) // 4 + 4 for message in messages)
+    return prompt_tokens + (max_tokens or 256)
+
+
+def parse_retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        parsed = email.utils.parsedate_tz(retry_after)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        # A request larger than the whole bucket only waits for a full bucket
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler:
+    """Single gate for every OpenAI call, shared by the interactive and batch flows.
+
+    Requests wait in one priority queue and are released in order (interactive
+    before batch, then first come first served) only when both the
+    requests-per-minute and tokens-per-minute buckets can cover them. A 429
+    pauses the whole queue for the Retry-After the server asked for, instead of
+    letting every caller retry on its own. Retries use exponential backoff with
+    full jitter so concurrent callers do not retry in lockstep. Every call is
+    timed into the metrics registry (queue wait, total time, retries, tokens)
+    under its description.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=40000, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            requests_per_minute=int(os.environ.get("DOCOTOC_RPM", 500)),
+            tokens_per_minute=int(os.environ.get("DOCOTOC_TPM", 40000)),
+            max_retries=int(os.environ.get("DOCOTOC_MAX_RETRIES", 5))
+        )
+
+    def _try_acquire(self, ticket, tokens):
+        """Returns 0 once ticket may go, else how long to wait (None: until notified)."""
+        if self._waiting[0] != ticket:
+            return None
+        now = time.monotonic()
+        delay = max(
+            self._paused_until - now,
+            self._requests.wait_time(1, now),
+            self._tokens.wait_time(tokens, now)
+        )
+        if delay > 0:
+            return delay
+        self._requests.consume(1)
+        self._tokens.consume(tokens)
+        heapq.heappop(self._waiting)
+        self.stats["requests"] += 1
+        self._ready.notify_all()
+        return 0
+
+    def _abandon(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+        self._ready.notify_all()
+
+    def acquire(self, priority=BATCH, tokens=0):
+        ticket = (priority, next(self._sequence))
+        with self._ready:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    delay = self._try_acquire(ticket, tokens)
+                    if delay == 0:
+                        return
+                    self._ready.wait(timeout=delay)
+            except BaseException:
+                self._abandon(ticket)
+                raise
+
+    async def acquire_async(self, priority=BATCH, tokens=0):
+        ticket = (priority, next(self._sequence))
+        with self._lock:
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._try_acquire(ticket, tokens)
+                if delay == 0:
+                    return
+                await asyncio.sleep(delay if delay is not None else ASYNC_POLL_INTERVAL)
+        except BaseException:
+            with self._lock:
+                self._abandon(ticket)
+            raise
+
+    def _record_usage(self, result, estimated_tokens, description):
+        usage = getattr(result, "usage", None)
+        total_tokens = getattr(usage, "total_tokens", None)
+        if total_tokens is None:
+            return
+        with self._lock:
+            self._tokens.consume(total_tokens - estimated_tokens)
+        metrics = get_metrics()
+        metrics.increment("docotoc_openai_tokens_total", usage.prompt_tokens or 0, operation=description, kind="prompt")
+        metrics.increment("docotoc_openai_tokens_total", usage.completion_tokens or 0, operation=description, kind="completion")
+
+    def _retry_delay(self, error, attempt, description):
+        """Backoff before the next attempt; a 429 also pauses the shared queue."""
+        retry_after = parse_retry_after(error)
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        get_metrics().increment("docotoc_openai_retries_total", operation=description, error=type(error).__name__)
+        with self._lock:
+            self.stats["retries"] += 1
+            if isinstance(error, RateLimitError):
+                self.stats["rate_limited"] += 1
+                pause = retry_after if retry_after is not None else backoff
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                self._requests.drain()
+                self._ready.notify_all()
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, backoff)
+
+    def _attempts(self, max_retries):
+        # A limit of 0 still sends the request once rather than returning None
+        return max(1, self.max_retries if max_retries is None else max_retries)
+
+    def _give_up(self, error, attempt, max_retries, description):
+        if attempt < max_retries - 1:
+            return False
+        with self._lock:
+            self.stats["failures"] += 1
+        logger.error(f"Max retries reached. Unable to complete {description}.")
+        return True
+
+    def call(self, request, priority=BATCH, estimated_tokens=0, max_retries=None, description="request"):
+        """Run request() once the budget allows it, retrying transient failures.
+
+        max_retries overrides the scheduler's configured limit for this call;
+        callers normally leave it as None.
+        """
+        max_retries = self._attempts(max_retries)
+        metrics = get_metrics()
+        with metrics.span(f"openai {description}", metric="docotoc_openai_call_seconds", operation=description):
+            for attempt in range(max_retries):
+                queued = time.perf_counter()
+                self.acquire(priority, estimated_tokens)
+                metrics.observe("docotoc_openai_queue_wait_seconds", time.perf_counter() - queued, operation=description)
+                try:
+                    result = request()
+                except RETRYABLE_ERRORS as e:
+                    if self._give_up(e, attempt, max_retries, description):
+                        raise
+                    wait_time = self._retry_delay(e, attempt, description)
+                    logger.warning(f"{type(e).__name__} during {description}. Retrying in {wait_time:.1f} seconds...")
+                    time.sleep(wait_time)
+                    continue
+                self._record_usage(result, estimated_tokens, description)
+                return result
+
+    async def call_async(self, request, priority=BATCH, estimated_tokens=0, max_retries=None, description="request"):
+        """Awaitable counterpart of call() for coroutine requests."""
+        max_retries = self._attempts(max_retries)
+        metrics = get_metrics()
+        with metrics.span(f"openai {description}", metric="docotoc_openai_call_seconds", operation=description):
+            for attempt in range(max_retries):
+                queued = time.perf_counter()
+                await self.acquire_async(priority, estimated_tokens)
+                metrics.observe("docotoc_openai_queue_wait_seconds", time.perf_counter() - queued, operation=description)
+                try:
+                    result = await request()
+                except RETRYABLE_ERRORS as e:
+                    if self._give_up(e, attempt, max_retries, description):
+                        raise
+                    wait_time = self._retry_delay(e, attempt, description)
+                    logger.warning(f"{type(e).__name__} during {description}. Retrying in {wait_time:.1f} seconds...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                self._record_usage(result, estimated_tokens, description)
+                return result
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler, configured from DOCOTOC_RPM / DOCOTOC_TPM."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler.from_env()
+        return _default_scheduler
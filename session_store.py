@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from conversation import ConversationContext
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# OrderedDict slot and link node per session on CPython, beyond the key,
+# entry tuple, timestamp and blob objects themselves
+ENTRY_OVERHEAD = 64
+
+
+def entry_bytes(session_id, entry):
+    """Memory held by one in-memory session, counted toward max_bytes."""
+    last_active, blob = entry
+    return sys.getsizeof(session_id) + sys.getsizeof(entry) + sys.getsizeof(last_active) + sys.getsizeof(blob) + ENTRY_OVERHEAD
+
+
+class Session:
+    """Working copy of one patient session, decoded from a SessionStore."""
+
+    __slots__ = ("session_id", "patient_name", "context", "doctor_shortlist")
+
+    def __init__(self, session_id, patient_name, context, doctor_shortlist=None):
+        self.session_id = session_id
+        self.patient_name = patient_name
+        self.context = context
+        self.doctor_shortlist = doctor_shortlist
+
+
+class SessionStore:
+    """Patient sessions keyed by session id, kept compact while idle.
+
+    Between turns a session is only a zlib-compressed JSON blob of the patient
+    name, the conversation turns and summary with their token counts, and the
+    doctor shortlist; get() decodes a working Session and save() encodes it
+    again. Sessions idle for longer than ttl expire, and once the sessions in
+    memory (blobs plus per-entry overhead) add up to more than max_bytes the
+    least recently used are evicted.
+    With db_path set every save is also written to SQLite, so evicted sessions
+    are reloaded on demand and sessions survive worker restarts.
+    """
+
+    # Expired rows are pruned from SQLite on every this many writes
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, db_path=None, context_options=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.context_options = context_options or {}
+        self.expired = 0
+        self.evicted = 0
+        self._bytes = 0
+        self._writes = 0
+        # session_id -> (last_active, blob), least recently active first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, last_active REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _encode(self, session):
+        shortlist = [[score, doctor] for score, doctor in session.doctor_shortlist or []]
+        payload = [session.patient_name, session.context.to_state(), shortlist]
+        return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+    def _decode(self, session_id, blob):
+        patient_name, state, shortlist = json.loads(zlib.decompress(blob))
+        context = ConversationContext.from_state(state, **self.context_options)
+        return Session(session_id, patient_name, context, [(score, doctor) for score, doctor in shortlist] or None)
+
+    def _remember(self, session_id, blob, last_active):
+        previous = self._sessions.pop(session_id, None)
+        if previous is not None:
+            self._bytes -= entry_bytes(session_id, previous)
+        entry = self._sessions[session_id] = (last_active, blob)
+        self._bytes += entry_bytes(session_id, entry)
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            evicted_id, evicted_entry = self._sessions.popitem(last=False)
+            self._bytes -= entry_bytes(evicted_id, evicted_entry)
+            self.evicted += 1
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry[0] < self.ttl:
+                break
+            del self._sessions[session_id]
+            self._bytes -= entry_bytes(session_id, entry)
+            self.expired += 1
+
+    def create(self, patient_name):
+        session = Session(uuid.uuid4().hex, patient_name, ConversationContext(**self.context_options))
+        self.save(session)
+        return session
+
+    def get(self, session_id):
+        """The session, or None if it is unknown or has expired."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                blob = entry[1]
+            elif self._db is not None:
+                row = self._db.execute("SELECT data, last_active FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                if row is None or now - row[1] >= self.ttl:
+                    return None
+                blob = row[0]
+            else:
+                return None
+            self._remember(session_id, blob, now)
+        return self._decode(session_id, blob)
+
+    def save(self, session):
+        blob = self._encode(session)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._remember(session.session_id, blob, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO sessions (id, data, last_active) VALUES (?, ?, ?)", (session.session_id, blob, now))
+                self._writes += 1
+                if self._writes % self.PRUNE_INTERVAL == 0:
+                    self._db.execute("DELETE FROM sessions WHERE last_active < ?", (now - self.ttl,))
+                self._db.commit()
+
+    def delete(self, session_id):
+        """Returns whether the session existed."""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry_bytes(session_id, entry)
+            deleted = entry is not None
+            if self._db is not None:
+                deleted = self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0 or deleted
+                self._db.commit()
+            return deleted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "expired": self.expired,
+                "evicted": self.evicted
+            }
@@ -0,0 +1,102 @@
+import json
+import time
+
+
+class IncrementalJsonDetector:
+    """Detects a reply that is a single JSON object while it is being streamed.
+
+    Chunks are fed as they arrive. The reply is treated as JSON only if its
+    first non-whitespace character is "{"; from then on brace depth is tracked
+    (ignoring braces inside strings) and the object is parsed as soon as the
+    closing brace arrives, without waiting for the rest of the stream.
+    """
+
+    def __init__(self):
+        self.result = None
+        self.complete = False
+        self._started = False
+        self._is_json = None
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    @property
+    def is_json(self):
+        return bool(self._is_json)
+
+    def feed(self, text):
+        if self.complete or self._is_json is False:
+            return
+        for char in text:
+            if not self._started:
+                if char.isspace():
+                    continue
+                self._started = True
+                self._is_json = char == "{"
+                if not self._is_json:
+                    return
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finish()
+                    return
+
+    def _finish(self):
+        try:
+            self.result = json.loads("".join(self._buffer))
+        except json.JSONDecodeError:
+            self._is_json = False
+            return
+        self.complete = True
+
+
+def consume_stream(stream, on_token=None, json_detector=None, stats=None):
+    """Collect the text of a streamed chat completion, forwarding each delta.
+
+    Stops reading early once json_detector has seen a complete JSON object,
+    since the assistant is told not to say anything after it. A stats dict,
+    if given, receives the perf_counter time of the first token
+    ("first_token") and the number of content chunks ("chunks").
+    """
+    parts = []
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            if stats is not None:
+                stats.setdefault("first_token", time.perf_counter())
+                stats["chunks"] = stats.get("chunks", 0) + 1
+            if on_token is not None:
+                on_token(delta)
+            if json_detector is not None:
+                json_detector.feed(delta)
+                if json_detector.complete:
+                    break
+    finally:
+        # A stream left half-read holds its pooled connection until garbage
+        # collection closes it, which can deadlock the next request on the pool
+        response = getattr(stream, "response", None)
+        if response is not None:
+            response.close()
+    return "".join(parts)
+
+
+def print_token(token):
+    print(token, end="", flush=True)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_classifier import IntentClassifier
+
+classifier = IntentClassifier()
+
+
+def test_medication_questions_go_to_gpt4():
+    assert classifier.fast_reply("my prescription makes me dizzy") is None
+    assert classifier.fast_reply("Is it safe to take my new prescription with ibuprofen?") is None
+
+
+def test_refill_requests_are_answered_locally():
+    assert classifier.out_of_scope_intent("I need a refill of my lisinopril") == "refill"
+    assert classifier.out_of_scope_intent("send my prescription to the pharmacy") == "refill"
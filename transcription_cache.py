@@ -0,0 +1,125 @@
+import os
+import hashlib
+import logging
+import threading
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "transcriptions")
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+
+def audio_cache_key(file_path, model, response_format, variant="", block_size=1024 * 1024):
+    """Content-addressed key: sha256 of the audio bytes plus the request parameters.
+
+    variant distinguishes transcriptions of the same file made differently,
+    e.g. after preprocessing.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as audio_file:
+        for block in iter(lambda: audio_file.read(block_size), b""):
+            digest.update(block)
+    digest.update(f"\0{model}\0{response_format}".encode("utf-8"))
+    if variant:
+        digest.update(f"\0{variant}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class TranscriptionCache:
+    """On-disk transcription cache with a size limit and LRU eviction.
+
+    Every entry is one file named after its key. Reads bump the file's mtime,
+    so the least recently used entries are the ones with the oldest mtime and
+    are removed first once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".txt")
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".txt"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as cached:
+                text = cached.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            get_metrics().increment("docotoc_cache_lookups_total", cache="transcription", result="miss")
+            return None
+        with self._lock:
+            self.hits += 1
+        get_metrics().increment("docotoc_cache_lookups_total", cache="transcription", result="hit")
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        data = text.encode("utf-8")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        self._total_bytes = total
+        if evicted:
+            logger.info(f"Evicted {evicted} cached transcriptions")
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self._total_bytes = None
+        return True
+
+    def clear(self):
+        removed = 0
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._total_bytes = 0
+        return removed